@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Padding Benchmark for richardutils
+
+Times pad_grid_with_nulls against the tuple grid and merge approach it
+replaced, on a synthetic partial block model.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from richardutils import pad_grid_with_nulls
+
+
+def merge_padding(df, x_min, x_max, y_min, y_max, z_min, z_max, x_step, y_step, z_step):
+    """
+    The previous implementation: tuple grid then a float key merge.
+    """
+    x = np.arange(x_min, x_max + x_step, x_step)
+    y = np.arange(y_min, y_max + y_step, y_step)
+    z = np.arange(z_min, z_max + z_step, z_step)
+    complete_grid = pd.DataFrame([(xi, yi, zi) for xi in x for yi in y for zi in z], columns=['x', 'y', 'z'])
+
+    return pd.merge(complete_grid, df, on=['x', 'y', 'z'], how='left')
+
+
+def block_model(nx, ny, nz, fill):
+    """
+    Random block model with a fraction of its cells present.
+    """
+    rng = np.random.default_rng(0)
+    cells = rng.choice(nx * ny * nz, int(nx * ny * nz * fill), replace=False)
+    ix, iy, iz = np.unravel_index(cells, (nx, ny, nz))
+    df = pd.DataFrame({'x': ix * 10.0, 'y': iy * 10.0, 'z': iz * 5.0 - nz * 5.0})
+    df['density'] = rng.uniform(2, 3, len(df))
+    df['grade'] = rng.lognormal(0, 1, len(df))
+
+    return df
+
+
+def timed(func, *args, repeat=3):
+    """
+    Returns the result and the best seconds taken over repeated calls.
+    """
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+
+    return result, best
+
+
+def main():
+    """Main entry point."""
+    parser = argparse.ArgumentParser(description='Benchmark block model padding')
+    parser.add_argument('--shape', type=int, nargs=3, default=[150, 150, 60], help='cells in x y z')
+    parser.add_argument('--fill', type=float, default=0.3, help='fraction of cells present')
+    parser.add_argument('--repeat', type=int, default=3, help='calls to take the best time of')
+    args = parser.parse_args()
+
+    nx, ny, nz = args.shape
+    df = block_model(nx, ny, nz, args.fill)
+    bounds = (0, (nx - 1) * 10.0, 0, (ny - 1) * 10.0, -nz * 5.0, -5.0, 10.0, 10.0, 5.0)
+    print(f"{len(df)} rows padded to {nx * ny * nz} cells")
+
+    new, new_seconds = timed(pad_grid_with_nulls, df, *bounds, repeat=args.repeat)
+    old, old_seconds = timed(merge_padding, df, *bounds, repeat=args.repeat)
+    pd.testing.assert_frame_equal(new, old)
+
+    print(f"tuple grid and merge: {old_seconds:.2f}s")
+    print(f"cell index scatter:   {new_seconds:.2f}s")
+    print(f"speedup:              {old_seconds / new_seconds:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
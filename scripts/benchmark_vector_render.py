@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Vector Rendering Benchmark for richardutils
+
+Times plotgdf on a large synthetic polygon layer drawn as full resolution
+vectors, with the pixel simplification pre-pass and rasterized.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import Polygon
+
+from richardutils import plotgdf
+
+
+def polygon_layer(n, vertices):
+    """
+    Grid of wobbly polygons, each with many vertices like digitised geology.
+    """
+    rng = np.random.default_rng(0)
+    side = int(np.ceil(np.sqrt(n)))
+    angles = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+    polygons = []
+    for i in range(n):
+        cx, cy = (i % side) * 1000.0, (i // side) * 1000.0
+        radius = 450 + 40 * rng.standard_normal(vertices).cumsum() / np.sqrt(vertices)
+        polygons.append(Polygon(np.column_stack([cx + radius * np.cos(angles), cy + radius * np.sin(angles)])))
+
+    return gpd.GeoDataFrame({'unit': rng.choice(list('ABCDEFGH'), n)}, geometry=polygons, crs='EPSG:28350')
+
+
+def timed(func, repeat=3, **kwargs):
+    """
+    Returns the best seconds taken over repeated calls, each saving a png.
+    """
+    best = np.inf
+    with tempfile.TemporaryDirectory() as tmp:
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            for _ in range(repeat):
+                start = time.perf_counter()
+                func(**kwargs)
+                best = min(best, time.perf_counter() - start)
+                plt.close('all')
+        finally:
+            os.chdir(cwd)
+
+    return best
+
+
+def main():
+    """Main entry point."""
+    parser = argparse.ArgumentParser(description='Benchmark plotgdf on a large polygon layer')
+    parser.add_argument('--polygons', type=int, default=2000, help='number of polygons')
+    parser.add_argument('--vertices', type=int, default=2000, help='vertices per polygon')
+    parser.add_argument('--size', type=float, default=7, help='figure size in inches')
+    parser.add_argument('--repeat', type=int, default=3, help='calls to take the best time of')
+    args = parser.parse_args()
+
+    gdf = polygon_layer(args.polygons, args.vertices)
+    print(f"{len(gdf)} polygons with {len(gdf) * args.vertices} vertices at {args.size} inches")
+
+    common = dict(gdf=gdf, column='unit', title='benchmark', size=args.size)
+    full = timed(plotgdf, repeat=args.repeat, simplify=False, **common)
+    simplified = timed(plotgdf, repeat=args.repeat, **common)
+    rasterized = timed(plotgdf, repeat=args.repeat, rasterize=True, **common)
+
+    print(f"full resolution vectors: {full:.2f}s")
+    print(f"simplified to 1 pixel:   {simplified:.2f}s ({full / simplified:.1f}x)")
+    print(f"rasterized:              {rasterized:.2f}s ({full / rasterized:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
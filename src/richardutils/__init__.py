@@ -1,16 +1,27 @@
 from .richardutils import *
 from .cli import cli
 
-from pkg_resources import get_distribution, DistributionNotFound
-try:
-    VERSION = get_distribution(__name__).version
-except DistributionNotFound:
+
+def __getattr__(name):
+    """
+    Look up the version only when it is asked for, importlib.metadata reads one
+    distribution where pkg_resources scanned every installed package at import.
+    """
+    if name not in ('VERSION', '__version__'):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    from importlib.metadata import version, PackageNotFoundError
     try:
-        from ._version import version as VERSION
-    except ImportError:
-        raise ImportError(
-            "Failed to find (autogenerated) _version.py. "
-            "This might be because you are installing from GitHub's tarballs, "
-            "use the PyPI ones."
-            )
-__version__ = VERSION
+        VERSION = version(__name__)
+    except PackageNotFoundError:
+        try:
+            from ._version import version as VERSION
+        except ImportError:
+            raise ImportError(
+                "Failed to find (autogenerated) _version.py. "
+                "This might be because you are installing from GitHub's tarballs, "
+                "use the PyPI ones."
+                )
+    globals().update(VERSION=VERSION, __version__=VERSION)
+
+    return VERSION
@@ -7,12 +7,17 @@ Licence: MIT
 import math
 import os
 import copy
+import io
 import json
 import os
+import time
+import weakref
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from functools import partial
 
 import numpy as np
 import pandas as pd
+import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib import cm
 from matplotlib.colors import ListedColormap, LinearSegmentedColormap
@@ -21,12 +26,18 @@ from osgeo import gdal
 
 import geopandas as gpd
 import fiona
+import shapely
 from shapely.geometry import box, mapping
+from pyproj import CRS
 
 import rasterio
+from affine import Affine
+import rasterio.features
+import rasterio.windows
 
 import xarray as xr
 import rioxarray
+from rioxarray.exceptions import NoDataInBounds
 import geocube
 from geocube.api.core import make_geocube
 from geocube.rasterize import rasterize_points_griddata, rasterize_points_radial, rasterize_image
@@ -60,298 +71,267 @@ def richardfunction(n: float) -> float:
     return math.sqrt(n)
     
     
-def cetrainbow():
+# CET perceptually uniform rainbow, 256 rgb colours
+_CET_RAINBOW = np.array([
+    [0, 48, 245], [0, 52, 242], [0, 55, 238], [0, 59, 235], [3, 62, 231], [9, 66, 228],
+    [14, 69, 225], [18, 72, 221], [20, 74, 218], [22, 77, 214], [23, 80, 211], [24, 82, 207],
+    [25, 85, 204], [25, 87, 200], [25, 90, 197], [25, 92, 193], [25, 94, 190], [25, 96, 187],
+    [24, 99, 183], [24, 101, 180], [24, 103, 177], [23, 105, 173], [23, 106, 170], [24, 108, 167],
+    [24, 110, 164], [25, 112, 160], [27, 113, 157], [28, 115, 154], [30, 117, 151], [32, 118, 148],
+    [34, 120, 145], [36, 121, 142], [39, 122, 139], [41, 124, 136], [43, 125, 133], [45, 126, 130],
+    [47, 128, 127], [49, 129, 124], [51, 130, 121], [53, 132, 118], [54, 133, 115], [56, 134, 112],
+    [57, 136, 109], [58, 137, 106], [59, 138, 103], [60, 139, 99], [61, 141, 96], [62, 142, 93],
+    [62, 143, 90], [63, 145, 87], [63, 146, 83], [64, 147, 80], [64, 149, 77], [64, 150, 74],
+    [65, 151, 70], [65, 153, 67], [65, 154, 63], [65, 155, 60], [66, 156, 56], [66, 158, 53],
+    [67, 159, 50], [68, 160, 46], [69, 161, 43], [70, 162, 40], [71, 163, 37], [73, 164, 34],
+    [75, 165, 31], [77, 166, 28], [79, 167, 26], [82, 168, 24], [84, 169, 22], [87, 170, 20],
+    [90, 171, 19], [93, 172, 18], [96, 173, 17], [99, 173, 17], [102, 174, 16], [105, 175, 16],
+    [108, 176, 16], [111, 176, 16], [114, 177, 17], [117, 178, 17], [121, 179, 17], [124, 179, 18],
+    [127, 180, 18], [130, 181, 19], [132, 182, 19], [135, 182, 20], [138, 183, 20], [141, 184, 20],
+    [144, 184, 21], [147, 185, 21], [150, 186, 22], [153, 186, 22], [155, 187, 23], [158, 188, 23],
+    [161, 188, 24], [164, 189, 24], [166, 190, 25], [169, 190, 25], [172, 191, 25], [175, 192, 26],
+    [177, 192, 26], [180, 193, 27], [183, 194, 27], [186, 194, 28], [188, 195, 28], [191, 195, 29],
+    [194, 196, 29], [196, 197, 30], [199, 197, 30], [202, 198, 30], [204, 199, 31], [207, 199, 31],
+    [210, 200, 32], [212, 200, 32], [215, 201, 33], [217, 201, 33], [220, 202, 34], [223, 202, 34],
+    [225, 202, 34], [227, 203, 35], [230, 203, 35], [232, 203, 35], [234, 203, 36], [236, 203, 36],
+    [238, 203, 36], [240, 203, 36], [241, 202, 36], [243, 202, 36], [244, 201, 36], [245, 200, 36],
+    [246, 200, 36], [247, 199, 36], [248, 197, 36], [248, 196, 36], [249, 195, 36], [249, 194, 35],
+    [249, 192, 35], [250, 191, 35], [250, 190, 35], [250, 188, 34], [250, 187, 34], [250, 185, 34],
+    [250, 184, 33], [250, 182, 33], [250, 180, 33], [250, 179, 32], [249, 177, 32], [249, 176, 32],
+    [249, 174, 31], [249, 173, 31], [249, 171, 31], [249, 169, 30], [249, 168, 30], [249, 166, 30],
+    [248, 165, 29], [248, 163, 29], [248, 161, 29], [248, 160, 29], [248, 158, 28], [248, 157, 28],
+    [248, 155, 28], [247, 153, 27], [247, 152, 27], [247, 150, 27], [247, 148, 26], [247, 147, 26],
+    [246, 145, 26], [246, 143, 26], [246, 142, 25], [246, 140, 25], [246, 138, 25], [245, 137, 24],
+    [245, 135, 24], [245, 133, 24], [245, 132, 24], [244, 130, 23], [244, 128, 23], [244, 127, 23],
+    [244, 125, 23], [244, 123, 22], [243, 121, 22], [243, 119, 22], [243, 118, 22], [243, 116, 21],
+    [242, 114, 21], [242, 112, 21], [242, 110, 21], [241, 109, 21], [241, 107, 21], [241, 105, 21],
+    [241, 103, 21], [240, 101, 21], [240, 100, 22], [240, 98, 22], [240, 96, 23], [240, 95, 24],
+    [240, 93, 26], [240, 92, 27], [240, 90, 29], [240, 89, 31], [240, 88, 33], [240, 87, 36],
+    [240, 87, 38], [241, 86, 41], [241, 86, 44], [242, 86, 47], [242, 86, 51], [243, 86, 54],
+    [243, 87, 58], [244, 88, 62], [245, 88, 65], [245, 89, 69], [246, 90, 73], [247, 91, 77],
+    [247, 92, 82], [248, 94, 86], [249, 95, 90], [249, 96, 94], [250, 97, 98], [251, 99, 102],
+    [251, 100, 106], [252, 101, 111], [252, 103, 115], [253, 104, 119], [253, 105, 123], [254, 107, 128],
+    [254, 108, 132], [255, 109, 136], [255, 111, 140], [255, 112, 145], [255, 114, 149], [255, 115, 153],
+    [255, 116, 157], [255, 118, 162], [255, 119, 166], [255, 120, 170], [255, 122, 175], [255, 123, 179],
+    [255, 125, 183], [255, 126, 188], [255, 127, 192], [255, 129, 196], [255, 130, 201], [255, 132, 205],
+    [255, 133, 210], [255, 134, 214], [255, 136, 219], [255, 137, 223], [255, 139, 227], [255, 140, 232],
+    [255, 141, 236], [254, 143, 241], [254, 144, 245], [253, 146, 250],
+], dtype=np.uint8)
+
+_CMAP_CACHE = {}
+
+
+def _cet_colormaps():
+    """
+    Build the CET rainbow colormaps once and register them with matplotlib
+    """
+    if not _CMAP_CACHE:
+        colors = np.column_stack([_CET_RAINBOW / 255, np.ones(len(_CET_RAINBOW))])
+        _CMAP_CACHE['cetrainbow'] = ListedColormap(colors, name='cetrainbow')
+        _CMAP_CACHE['cetrainbow_r'] = _CMAP_CACHE['cetrainbow'].reversed()
+        for name, cmap in _CMAP_CACHE.items():
+            if name not in matplotlib.colormaps:
+                matplotlib.colormaps.register(cmap, name=name)
+
+    return _CMAP_CACHE
+
+
+def cetrainbow(reverse=False):
     """
     Make a CET perceptually uniform rainbow colormap
-    newcmp = cetrainbow()
-    cm.register_cmap(name='cetrainbow', cmap=newcmp)
-
-    To reverse: cet_r = ListedColormap(newcmp.colors[::-1])
-                cm.register_cmap(name='cetrainbow_r', cmap=cet_r)
-
-    """
-
-    CET = """0 0 48 245
-1 0 52 242
-2 0 55 238
-3 0 59 235
-4 3 62 231
-5 9 66 228
-6 14 69 225
-7 18 72 221
-8 20 74 218
-9 22 77 214
-10 23 80 211
-11 24 82 207
-12 25 85 204
-13 25 87 200
-14 25 90 197
-15 25 92 193
-16 25 94 190
-17 25 96 187
-18 24 99 183
-19 24 101 180
-20 24 103 177
-21 23 105 173
-22 23 106 170
-23 24 108 167
-24 24 110 164
-25 25 112 160
-26 27 113 157
-27 28 115 154
-28 30 117 151
-29 32 118 148
-30 34 120 145
-31 36 121 142
-32 39 122 139
-33 41 124 136
-34 43 125 133
-35 45 126 130
-36 47 128 127
-37 49 129 124
-38 51 130 121
-39 53 132 118
-40 54 133 115
-41 56 134 112
-42 57 136 109
-43 58 137 106
-44 59 138 103
-45 60 139 99
-46 61 141 96
-47 62 142 93
-48 62 143 90
-49 63 145 87
-50 63 146 83
-51 64 147 80
-52 64 149 77
-53 64 150 74
-54 65 151 70
-55 65 153 67
-56 65 154 63
-57 65 155 60
-58 66 156 56
-59 66 158 53
-60 67 159 50
-61 68 160 46
-62 69 161 43
-63 70 162 40
-64 71 163 37
-65 73 164 34
-66 75 165 31
-67 77 166 28
-68 79 167 26
-69 82 168 24
-70 84 169 22
-71 87 170 20
-72 90 171 19
-73 93 172 18
-74 96 173 17
-75 99 173 17
-76 102 174 16
-77 105 175 16
-78 108 176 16
-79 111 176 16
-80 114 177 17
-81 117 178 17
-82 121 179 17
-83 124 179 18
-84 127 180 18
-85 130 181 19
-86 132 182 19
-87 135 182 20
-88 138 183 20
-89 141 184 20
-90 144 184 21
-91 147 185 21
-92 150 186 22
-93 153 186 22
-94 155 187 23
-95 158 188 23
-96 161 188 24
-97 164 189 24
-98 166 190 25
-99 169 190 25
-100 172 191 25
-101 175 192 26
-102 177 192 26
-103 180 193 27
-104 183 194 27
-105 186 194 28
-106 188 195 28
-107 191 195 29
-108 194 196 29
-109 196 197 30
-110 199 197 30
-111 202 198 30
-112 204 199 31
-113 207 199 31
-114 210 200 32
-115 212 200 32
-116 215 201 33
-117 217 201 33
-118 220 202 34
-119 223 202 34
-120 225 202 34
-121 227 203 35
-122 230 203 35
-123 232 203 35
-124 234 203 36
-125 236 203 36
-126 238 203 36
-127 240 203 36
-128 241 202 36
-129 243 202 36
-130 244 201 36
-131 245 200 36
-132 246 200 36
-133 247 199 36
-134 248 197 36
-135 248 196 36
-136 249 195 36
-137 249 194 35
-138 249 192 35
-139 250 191 35
-140 250 190 35
-141 250 188 34
-142 250 187 34
-143 250 185 34
-144 250 184 33
-145 250 182 33
-146 250 180 33
-147 250 179 32
-148 249 177 32
-149 249 176 32
-150 249 174 31
-151 249 173 31
-152 249 171 31
-153 249 169 30
-154 249 168 30
-155 249 166 30
-156 248 165 29
-157 248 163 29
-158 248 161 29
-159 248 160 29
-160 248 158 28
-161 248 157 28
-162 248 155 28
-163 247 153 27
-164 247 152 27
-165 247 150 27
-166 247 148 26
-167 247 147 26
-168 246 145 26
-169 246 143 26
-170 246 142 25
-171 246 140 25
-172 246 138 25
-173 245 137 24
-174 245 135 24
-175 245 133 24
-176 245 132 24
-177 244 130 23
-178 244 128 23
-179 244 127 23
-180 244 125 23
-181 244 123 22
-182 243 121 22
-183 243 119 22
-184 243 118 22
-185 243 116 21
-186 242 114 21
-187 242 112 21
-188 242 110 21
-189 241 109 21
-190 241 107 21
-191 241 105 21
-192 241 103 21
-193 240 101 21
-194 240 100 22
-195 240 98 22
-196 240 96 23
-197 240 95 24
-198 240 93 26
-199 240 92 27
-200 240 90 29
-201 240 89 31
-202 240 88 33
-203 240 87 36
-204 240 87 38
-205 241 86 41
-206 241 86 44
-207 242 86 47
-208 242 86 51
-209 243 86 54
-210 243 87 58
-211 244 88 62
-212 245 88 65
-213 245 89 69
-214 246 90 73
-215 247 91 77
-216 247 92 82
-217 248 94 86
-218 249 95 90
-219 249 96 94
-220 250 97 98
-221 251 99 102
-222 251 100 106
-223 252 101 111
-224 252 103 115
-225 253 104 119
-226 253 105 123
-227 254 107 128
-228 254 108 132
-229 255 109 136
-230 255 111 140
-231 255 112 145
-232 255 114 149
-233 255 115 153
-234 255 116 157
-235 255 118 162
-236 255 119 166
-237 255 120 170
-238 255 122 175
-239 255 123 179
-240 255 125 183
-241 255 126 188
-242 255 127 192
-243 255 129 196
-244 255 130 201
-245 255 132 205
-246 255 133 210
-247 255 134 214
-248 255 136 219
-249 255 137 223
-250 255 139 227
-251 255 140 232
-252 255 141 236
-253 254 143 241
-254 254 144 245
-255 253 146 250
-"""
+    The colormap is built once and registered with matplotlib as 'cetrainbow' and 'cetrainbow_r',
+    so cmap='cetrainbow' works anywhere after the first call or the first plot
+
+    Args:
+        reverse: return the reversed colormap
 
-    import io
+    Returns:
+        a copy of the cached ListedColormap
 
-    data = io.StringIO(CET)
-    df = pd.read_csv(data, sep=" ", header=None,names=["i",'r','g','b'], low_memory=False)
+    Examples:
+        newcmp = cetrainbow()
+        cet_r = cetrainbow(reverse=True)
+    """
+    return _cet_colormaps()['cetrainbow_r' if reverse else 'cetrainbow'].copy()
 
-    def makecmp(df):
-        df['r'] = df['r']/255
-        df['g'] = df['g']/255
-        df['b'] = df['b']/255
 
-        del df['i']
-        df['a'] = (df['r']+df['g']+df['b']+0.001)/(df['r']+df['g']+df['b']+0.001)
-        arr = df.to_numpy()
-        newcmp = ListedColormap(arr)
-        
-        return newcmp
+def _resolve_cmap(cmap):
+    """
+    Make sure a colormap name can be found by matplotlib
+    The CET rainbow is registered on first use, other CET names e.g. 'cet_fire' are registered by colorcet if installed
+    """
+    if isinstance(cmap, str):
+        if cmap in ('cetrainbow', 'cetrainbow_r'):
+            _cet_colormaps()
+        elif cmap not in matplotlib.colormaps:
+            try:
+                import colorcet
+            except ImportError:
+                pass
 
-    newcmp = makecmp(df)
-    
-    return newcmp
+    return cmap
+
+
+def _window_mode(x, axis):
+    """
+    Most common value over the window axes of an array, nan is never the mode unless the window is all nan
+    """
+    if hasattr(x, "__dask_graph__"):
+        x = x.rechunk({a: -1 for a in axis})
+        return x.map_blocks(_window_mode, axis=axis, drop_axis=axis, dtype=x.dtype)
+
+    x = np.moveaxis(x, axis, tuple(range(-len(axis), 0)))
+    x = np.sort(x.reshape(x.shape[:-len(axis)] + (-1,)), axis=-1)
+    n = x.shape[-1]
+    position = np.arange(n)
+    starts = np.where(np.concatenate([np.ones(x.shape[:-1] + (1,), dtype=bool), x[..., 1:] != x[..., :-1]], axis=-1), position, 0)
+    run_length = position - np.maximum.accumulate(starts, axis=-1) + 1
+    if x.dtype.kind == 'f':
+        run_length[np.isnan(x)] = 0
+    end = np.argmax(run_length, axis=-1)[..., None]
+
+    return np.take_along_axis(x, end, axis=-1)[..., 0]
+
+
+def _overview(da, factor):
+    """
+    Reopen the file a DataArray was read from at the coarsest overview no coarser than factor
+    Returns None when there is no file, no overviews or the DataArray no longer matches the file
+    """
+    source = da.encoding.get('source')
+    if source is None or not {'x', 'y'} <= set(da.dims):
+        return None
+    try:
+        with rasterio.open(source) as src:
+            if (src.height, src.width) != da.rio.shape or src.transform != da.rio.transform():
+                return None
+            levels = [i for i, f in enumerate(src.overviews(1)) if f <= factor]
+    except rasterio.errors.RasterioIOError:
+        return None
+    if not levels:
+        return None
+
+    ov = rioxarray.open_rasterio(
+        source,
+        overview_level=levels[-1],
+        chunks=True if _is_dask(da) else None,
+        masked='_FillValue' in da.encoding,
+    )
+    if 'band' in ov.dims:
+        ov = ov.sel(band=da['band'].values) if 'band' in da.coords else ov.squeeze('band', drop=True)
+    ov.name = da.name
+    ov.attrs = da.attrs
+
+    return ov
 
 
-def plotmap(da, robust=False, cmap='cetrainbow', size=6, title='Title Here', clip=None, savefig=True, slide_dict=None, background=False):
+def _screen_decimate(da, size, dpi=None, method='auto'):
+    """
+    Reduce a DataArray to about the resolution it will be drawn at before plotting
+    The target is size * dpi pixels along the longer of the last two dims. For mean reduction raster overviews
+    are used when the DataArray was opened from a file that has them, then blocks are reduced with mean, max or mode.
+    Dask backed arrays stay lazy so only the decimated result is ever computed.
+
+    Args:
+        da: A DataArray
+        size: figure size in inches
+        dpi: dots per inch, defaults to the matplotlib figure dpi
+        method: 'mean', 'max', 'mode', 'auto' for mode on boolean grids and grids with CF flag_values or
+                flag_meanings attrs and mean otherwise, or None to skip decimation
+
+    Returns:
+        decimated DataArray, da itself if it is already small enough
+    """
+    if method is None:
+        return da
+    if method == 'auto':
+        categorical = da.dtype.kind == 'b' or 'flag_values' in da.attrs or 'flag_meanings' in da.attrs
+        method = 'mode' if categorical else 'mean'
+    if method not in ('mean', 'max', 'mode'):
+        raise ValueError(f"method must be 'mean', 'max', 'mode' or 'auto', not {method!r}")
+
+    dpi = plt.rcParams['figure.dpi'] if dpi is None else dpi
+    target = max(int(size * dpi), 1)
+    ydim, xdim = da.dims[-2:]
+    factor = int(np.ceil(max(da.sizes[ydim], da.sizes[xdim]) / target))
+    if factor <= 1:
+        return da
+
+    ov = _overview(da, factor) if method == 'mean' else None
+    if ov is not None:
+        da = ov
+        factor = int(np.ceil(max(da.sizes[ydim], da.sizes[xdim]) / target))
+        if factor <= 1:
+            return da
+
+    window = da.coarsen({ydim: factor, xdim: factor}, boundary='trim')
+    if method == 'mean':
+        return window.mean()
+    if method == 'max':
+        return window.max()
+
+    return window.reduce(_window_mode)
+
+
+_PLOT_LIMITS_CACHE = {}
+
+
+def plot_limits(da, clip=None, robust=False, sample=1_000_000, bins=4096, min_value=None):
+    """
+    Colour limits for plotting a DataArray without sorting the whole array
+    Percentiles come from a strided sample of numpy backed arrays or a streaming histogram of dask backed arrays.
+    Limits are cached per array so re-plotting the same DataArray does not recompute them,
+    the cache entry is dropped when the DataArray is garbage collected.
+
+    Args:
+        da: A DataArray
+        clip: percentile to clip the top of the colour scale to, e.g. 98
+        robust: use the 2nd and 98th percentiles like xarray's robust
+        sample: largest number of values read from a numpy array, exact when the array is smaller
+        bins: histogram bins for dask arrays, the error is at most (max - min) / bins
+        min_value: only values at or above this count towards the percentiles, e.g. 0 when negatives are masked
+
+    Returns:
+        (vmin, vmax), either can be None to leave it to matplotlib
+
+    Examples:
+        vmin, vmax = plot_limits(da, clip=98)
+    """
+    q = []
+    if robust:
+        q.append(2.0)
+    if clip is not None:
+        q.append(float(clip))
+    elif robust:
+        q.append(98.0)
+    if not q:
+        return None, None
+
+    key = (id(da), clip, robust, sample, bins, min_value)
+    cached = _PLOT_LIMITS_CACHE.get(key)
+    if cached is not None and cached[0]() is da:
+        return cached[1]
+
+    if _is_dask(da):
+        values = _approx_percentiles(da if min_value is None else da.where(da >= min_value), q, bins=bins)
+    else:
+        flat = np.asarray(da.data).ravel()
+        step = max(int(np.ceil(flat.size / sample)), 1)
+        flat = flat[::step]
+        if min_value is not None:
+            flat = flat[flat >= min_value]
+        values = np.nanpercentile(flat, q)
+
+    values = [float(v) for v in values]
+    limits = (values[0] if robust else None, values[-1])
+
+    ref = weakref.ref(da, lambda ref, key=key: _PLOT_LIMITS_CACHE.pop(key, None))
+    _PLOT_LIMITS_CACHE[key] = (ref, limits)
+
+    return limits
+
+
+def plotmap(da, robust=False, cmap='cetrainbow', size=6, title='Title Here', clip=None, savefig=True, slide_dict=None, background=False, dpi=None, decimate='auto'):
     """
     Plot a dataarray with a title.
     Allow saving to a png
@@ -359,6 +339,9 @@ def plotmap(da, robust=False, cmap='cetrainbow', size=6, title='Title Here', cli
 
     Args:
         da: A DataArray
+        dpi: dots per inch of the figure, defaults to the matplotlib figure dpi
+        decimate: 'mean', 'max' or 'mode' block reduction to screen resolution before plotting, 'auto' for mode
+                  on boolean or flag_values class grids and mean otherwise, None to plot every cell
         robust: clip to 2/98 or not
         cmap: a matplotlib colormap
         size: integer size of plot
@@ -374,8 +357,12 @@ def plotmap(da, robust=False, cmap='cetrainbow', size=6, title='Title Here', cli
     Examples:
     
     """
+    cmap = _resolve_cmap(cmap)
+
+    vmin, vmax = plot_limits(da, clip=clip, robust=robust)
+    da = _screen_decimate(da, size, dpi=dpi, method=decimate)
 
-    fig, ax = plt.subplots(figsize=(size,size))
+    fig, ax = plt.subplots(figsize=(size,size), dpi=dpi)
     if background is False:
         pass
     elif background is True:
@@ -385,11 +372,7 @@ def plotmap(da, robust=False, cmap='cetrainbow', size=6, title='Title Here', cli
     else:
         background.plot()
         
-    if clip is not None:
-        quantile = np.nanpercentile(da, clip)
-        da.plot(cmap=cmap, robust=robust, ax=ax, vmax=quantile)
-    else:
-        da.plot(cmap=cmap, robust=robust, ax=ax)
+    da.plot(cmap=cmap, ax=ax, vmin=vmin, vmax=vmax)
     plt.title(title)
     ax.axes.set_aspect('equal')
     if savefig:
@@ -399,7 +382,7 @@ def plotmap(da, robust=False, cmap='cetrainbow', size=6, title='Title Here', cli
             slide_dict[title] = title + '.png'
 
 
-def plotmap3(da, robust=False, cmap='cetrainbow', size=6, title='Title Here', clip=None, savefig=True, slide_dict=None, background=False):
+def plotmap3(da, robust=False, cmap='cetrainbow', size=6, title='Title Here', clip=None, savefig=True, slide_dict=None, background=False, dpi=None, decimate='auto'):
     """
     Plot a dataarray with a title.
     Allow saving to a png
@@ -407,6 +390,9 @@ def plotmap3(da, robust=False, cmap='cetrainbow', size=6, title='Title Here', cl
 
     Args:
         da: A DataArray with 3 bands
+        dpi: dots per inch of the figure, defaults to the matplotlib figure dpi
+        decimate: 'mean', 'max' or 'mode' block reduction to screen resolution before plotting, 'auto' for mode
+                  on boolean or flag_values class grids and mean otherwise, None to plot every cell
         robust: clip to 2/98 or not
         cmap: a matplotlib colormap
         size: integer size of plot
@@ -422,8 +408,12 @@ def plotmap3(da, robust=False, cmap='cetrainbow', size=6, title='Title Here', cl
     Examples:
     
     """
+    cmap = _resolve_cmap(cmap)
 
-    fig, ax = plt.subplots(figsize=(size,size))
+    vmin, vmax = plot_limits(da, clip=clip, robust=robust)
+    da = _screen_decimate(da, size, dpi=dpi, method=decimate)
+
+    fig, ax = plt.subplots(figsize=(size,size), dpi=dpi)
     if background is False:
         pass
     elif background is True:
@@ -433,11 +423,7 @@ def plotmap3(da, robust=False, cmap='cetrainbow', size=6, title='Title Here', cl
     else:
         background.plot()
         
-    if clip is not None:
-        quantile = np.nanpercentile(da, clip)
-        da.plot.imshow(cmap=cmap, robust=robust, ax=ax, vmax=quantile)
-    else:
-        da.plot.imshow(cmap=cmap, robust=robust, ax=ax)
+    da.plot.imshow(cmap=cmap, ax=ax, vmin=vmin, vmax=vmax)
     plt.title(title)
     ax.axes.set_aspect('equal')
     if savefig:
@@ -447,7 +433,7 @@ def plotmap3(da, robust=False, cmap='cetrainbow', size=6, title='Title Here', cl
             slide_dict[title] = title + '.png'
             
             
-def plotmap_background(da, robust=False, cmap='cetrainbow', size=6, title='Title Here', clip=None, savefig=True, slide_dict=None, background=False, alpha=0.999):
+def plotmap_background(da, robust=False, cmap='cetrainbow', size=6, title='Title Here', clip=None, savefig=True, slide_dict=None, background=False, alpha=0.999, dpi=None, decimate='auto'):
     """
     Plot a dataarray with a title.
     Allow saving to a png
@@ -455,6 +441,9 @@ def plotmap_background(da, robust=False, cmap='cetrainbow', size=6, title='Title
 
     Args:
         da: A DataArray
+        dpi: dots per inch of the figure, defaults to the matplotlib figure dpi
+        decimate: 'mean', 'max' or 'mode' block reduction to screen resolution before plotting, 'auto' for mode
+                  on boolean or flag_values class grids and mean otherwise, None to plot every cell
         robust: clip to 2/98 or not
         cmap: a matplotlib colormap
         size: integer size of plot
@@ -470,8 +459,15 @@ def plotmap_background(da, robust=False, cmap='cetrainbow', size=6, title='Title
     Examples:
     
     """
+    cmap = _resolve_cmap(cmap)
+
+    # negative cells are masked below, so they are left out of the percentiles
+    vmin, vmax = plot_limits(da, clip=clip, robust=robust, min_value=0)
+    da = _screen_decimate(da, size, dpi=dpi, method=decimate)
+    if isinstance(background, xr.DataArray):
+        background = _screen_decimate(background, size, dpi=dpi, method=decimate)
 
-    fig, ax = plt.subplots(figsize=(size,size))
+    fig, ax = plt.subplots(figsize=(size,size), dpi=dpi)
     if background is False:
         pass
     elif background is True:
@@ -487,14 +483,11 @@ def plotmap_background(da, robust=False, cmap='cetrainbow', size=6, title='Title
         
     da = da.where(da >=0, drop=True)
     
-    if clip is not None:
-        quantile = np.nanpercentile(da, clip)
-        da.plot(cmap=cmap, robust=robust, ax=ax, vmax=quantile)
-    else:
+    if clip is None:
         x_range = plt.xlim()
         y_range = plt.ylim()
         
-        da.plot(cmap=cmap, robust=robust, ax=ax)
+    da.plot(cmap=cmap, ax=ax, vmin=vmin, vmax=vmax)
         
     plt.title(title)
     ax.axes.set_aspect('equal')
@@ -508,7 +501,7 @@ def plotmap_background(da, robust=False, cmap='cetrainbow', size=6, title='Title
             slide_dict[title] = title + '.png'
             
         
-def plotmapc(da, robust=False, cmap='cetrainbow', size=6, title='Title Here', clip=None, savefig=True, slide_dict=None, background=False):
+def plotmapc(da, robust=False, cmap='cetrainbow', size=6, title='Title Here', clip=None, savefig=True, slide_dict=None, background=False, dpi=None, decimate='auto'):
     """
     Plots a dataarray and makes the colorbar the same height as the plot
     
@@ -518,6 +511,9 @@ def plotmapc(da, robust=False, cmap='cetrainbow', size=6, title='Title Here', cl
 
     Args:
         da: A DataArray
+        dpi: dots per inch of the figure, defaults to the matplotlib figure dpi
+        decimate: 'mean', 'max' or 'mode' block reduction to screen resolution before plotting, 'auto' for mode
+                  on boolean or flag_values class grids and mean otherwise, None to plot every cell
         robust: clip to 2/98 or not
         cmap: a matplotlib colormap
         size: integer size of plot
@@ -533,8 +529,12 @@ def plotmapc(da, robust=False, cmap='cetrainbow', size=6, title='Title Here', cl
     Examples: plotmapc(da_exploding_stars, cmap='magma', title='Exploding Stars')
     
     """
+    cmap = _resolve_cmap(cmap)
 
-    fig, ax = plt.subplots(figsize=(size,size))
+    vmin, vmax = plot_limits(da, clip=clip, robust=robust)
+    da = _screen_decimate(da, size, dpi=dpi, method=decimate)
+
+    fig, ax = plt.subplots(figsize=(size,size), dpi=dpi)
     if background is False:
         pass
     elif background is True:
@@ -544,11 +544,7 @@ def plotmapc(da, robust=False, cmap='cetrainbow', size=6, title='Title Here', cl
     else:
         background.plot()
         
-    if clip is not None:
-        quantile = np.nanpercentile(da, clip)
-        im = da.plot(cmap=cmap, robust=robust, ax=ax, vmax=quantile,add_colorbar=False)
-    else:
-        im = da.plot(cmap=cmap, robust=robust, ax=ax, add_colorbar=False)
+    im = da.plot(cmap=cmap, ax=ax, vmin=vmin, vmax=vmax, add_colorbar=False)
     plt.title(title)
     ax.axes.set_aspect('equal')
     
@@ -562,8 +558,70 @@ def plotmapc(da, robust=False, cmap='cetrainbow', size=6, title='Title Here', cl
             slide_dict[title] = title + '.png'
 
         
-def plothist(da, title, color='Orange', savefig=True, slide_dict = None):
-    da.plot.hist(density=True, color=color)
+def _histogram_edges(das, bins=10, range=None):
+    """
+    Bin edges shared by one or more DataArrays, the range is found in one pass over all of them
+    """
+    if np.ndim(bins):
+        return np.asarray(bins, dtype='float64')
+    if range is None:
+        limits = _minmax(*das)
+        range = (min(lo for lo, hi in limits), max(hi for lo, hi in limits))
+    lo, hi = range
+    if lo == hi:
+        lo, hi = lo - 0.5, hi + 0.5
+
+    return np.linspace(lo, hi, bins + 1)
+
+
+def histogram_counts(da, bins=10, range=None):
+    """
+    Histogram of a DataArray without flattening it into memory
+    dask backed arrays are binned chunk by chunk so memory is bounded by the chunk size, nan values are ignored
+
+    Args:
+        da: A DataArray
+        bins: number of equal width bins or an array of bin edges
+        range: (min, max) of the bins, found from the data if not given
+
+    Returns:
+        counts and bin edges
+
+    Examples:
+        counts, edges = histogram_counts(damag, bins=100)
+    """
+    edges = _histogram_edges([da], bins=bins, range=range)
+
+    return _histogram(da, edges), edges
+
+
+def _plot_counts(counts, edges, color):
+    """
+    Draw a density histogram from precomputed counts
+    """
+    plt.hist(edges[:-1], bins=edges, weights=counts, density=True, color=color)
+
+
+def plothist(da, title, color='Orange', savefig=True, slide_dict = None, bins=10, range=None):
+    """
+    Plot a histogram of a dataarray with a log scale and a title.
+    Allow saving to a png
+    Allow adding to a dictionary e.g. for presentation use
+
+    Args:
+        da: A DataArray
+        title: title of plot
+        color: string color for the histogram
+        savefig: write a png to the directory
+        slide_dict: dictionary to store reference to plots in
+        bins: number of bins or an array of bin edges
+        range: (min, max) of the bins, found from the data if not given
+
+    Returns:
+        counts and bin edges so the histogram can be reused
+    """
+    counts, edges = histogram_counts(da, bins=bins, range=range)
+    _plot_counts(counts, edges, color)
     plt.yscale('log')
     plt.title(title)
     if savefig:
@@ -571,8 +629,10 @@ def plothist(da, title, color='Orange', savefig=True, slide_dict = None):
         if slide_dict is not None:        
             slide_dict[title] = title + '.png'        
 
+    return counts, edges
+
         
-def plothist_combo(da, da2, title, color1='Orange',color2='Gold', savefig=True, slide_dict = None):
+def plothist_combo(da, da2, title, color1='Orange',color2='Gold', savefig=True, slide_dict = None, bins=10, range=None):
     """
     Plot a geodataframe with a title.
     Allow saving to a png
@@ -587,9 +647,17 @@ def plothist_combo(da, da2, title, color1='Orange',color2='Gold', savefig=True,
         alpha: transparently
         savefig: write a png to the directory
         slide_dict: dictionary to store reference to plots in
+        bins: number of bins or an array of bin edges, shared by both histograms
+        range: (min, max) of the bins, found from both DataArrays if not given
+
+    Returns:
+        counts of da, counts of da2 and the shared bin edges
     """
-    da.plot.hist(density=True, color=color1)
-    da2.plot.hist(density=True, color=color2)
+    edges = _histogram_edges([da, da2], bins=bins, range=range)
+    counts = _histogram(da, edges)
+    counts2 = _histogram(da2, edges)
+    _plot_counts(counts, edges, color1)
+    _plot_counts(counts2, edges, color2)
     plt.yscale('log')
     plt.title(title) 
     if savefig:
@@ -597,8 +665,86 @@ def plothist_combo(da, da2, title, color1='Orange',color2='Gold', savefig=True,
         if slide_dict is not None:        
             slide_dict[title] = title + '.png'  
 
+    return counts, counts2, edges
+
+
+def _gdf_view(gdf, size, dpi=None, extent=None, simplify=True):
+    """
+    Reduce a GeoDataFrame to what can be seen in a figure before plotting
+    Features outside the extent are dropped with the spatial index, the rest are cut to the extent
+    and simplified to the width of one pixel at the figure size and dpi, features that would
+    simplify away entirely are kept as they are
+
+    Returns:
+        GeoDataFrame and the (minx, miny, maxx, maxy) extent
+    """
+    if extent is None:
+        extent = tuple(gdf.total_bounds)
+    else:
+        gdf = gdf.iloc[np.sort(gdf.sindex.query(box(*extent), predicate='intersects'))]
+        gdf = gdf.set_geometry(gdf.geometry.clip_by_rect(*extent))
+
+    if simplify and len(gdf):
+        dpi = plt.rcParams['figure.dpi'] if dpi is None else dpi
+        tolerance = max(extent[2] - extent[0], extent[3] - extent[1]) / (size * dpi)
+        simplified = gdf.geometry.simplify(tolerance, preserve_topology=False)
+        gdf = gdf.set_geometry(simplified.where(~simplified.is_empty, gdf.geometry))
+
+    return gdf, extent
+
+
+def _plot_gdf_raster(gdf, column, extent, size, ax, dpi=None, cmap=None, color=None, alpha=0.5, legend=False):
+    """
+    Draw a GeoDataFrame as an image burnt at screen resolution instead of as vector patches
+    Later features are drawn over earlier ones, as gdf.plot does
+    """
+    from matplotlib.patches import Patch
+
+    dpi = plt.rcParams['figure.dpi'] if dpi is None else dpi
+    minx, miny, maxx, maxy = extent
+    scale = max(maxx - minx, maxy - miny) / (size * dpi)
+    width = max(int(np.ceil((maxx - minx) / scale)), 1)
+    height = max(int(np.ceil((maxy - miny) / scale)), 1)
+
+    categories = None
+    if column is None or color is not None:
+        values = np.zeros(len(gdf))
+        cmap = ListedColormap([color if color is not None else 'C0'])
+    elif pd.api.types.is_numeric_dtype(gdf[column]):
+        values = gdf[column].to_numpy(dtype='float64')
+    else:
+        values, categories = pd.factorize(gdf[column])
+        cmap = matplotlib.colormaps[cmap] if isinstance(cmap, str) else cmap
+        cmap = cmap.resampled(max(len(categories), 1))
+
+    grid = np.full((height, width), np.nan, dtype='float32')
+    if len(gdf):
+        rasterio.features.rasterize(
+            zip(gdf.geometry.values, values),
+            out=grid,
+            transform=Affine(scale, 0, minx, 0, -scale, maxy),
+            all_touched=True,
+        )
+
+    limits = dict(vmin=-0.5, vmax=len(categories) - 0.5) if categories is not None else {}
+    im = ax.imshow(
+        grid,
+        extent=(minx, minx + width * scale, maxy - height * scale, maxy),
+        cmap=cmap,
+        alpha=alpha,
+        interpolation='nearest',
+        **limits,
+    )
+
+    if legend and categories is not None:
+        ax.legend(handles=[Patch(facecolor=cmap(i), alpha=alpha, label=str(c)) for i, c in enumerate(categories)])
+    elif legend and column is not None and color is None:
+        plt.colorbar(im, ax=ax)
+
+    return im
 
-def plotgdf(gdf, column, title,alpha=0.5, savefig=True, cmap='cetrainbow', slide_dict=None, size=7, legend=False):
+
+def plotgdf(gdf, column, title,alpha=0.5, savefig=True, cmap='cetrainbow', slide_dict=None, size=7, legend=False, dpi=None, extent=None, simplify=True, rasterize=False):
     """
     Plot a gepdataframe with a title.
     Allow saving to a png
@@ -612,21 +758,33 @@ def plotgdf(gdf, column, title,alpha=0.5, savefig=True, cmap='cetrainbow', slide
         savefig: write a png to the directory
         cmap: a matplotlib colormap
         slide_dict: dictionary to store reference to plots in
+        dpi: dots per inch of the figure, defaults to the matplotlib figure dpi
+        extent: (minx, miny, maxx, maxy) to zoom to, features outside it are not drawn
+        simplify: simplify geometries to one pixel at the figure size before drawing
+        rasterize: draw the features as an image at screen resolution, for dense layers
 
 
     Examples:
-    
+        plotgdf(gdf_geology, 'UNITNAME', 'Geology', extent=(115, -32, 117, -30), rasterize=True)
     """
-    fig, ax = plt.subplots(figsize=(size,size))
-    gdf.plot(column=column,  alpha=alpha, cmap=cmap, legend=legend, ax=ax)
+    cmap = _resolve_cmap(cmap)
+    gdf, view = _gdf_view(gdf, size, dpi=dpi, extent=extent, simplify=simplify)
+    fig, ax = plt.subplots(figsize=(size,size), dpi=dpi)
+    if rasterize:
+        _plot_gdf_raster(gdf, column, view, size, ax, dpi=dpi, cmap=cmap, alpha=alpha, legend=legend)
+    else:
+        gdf.plot(column=column,  alpha=alpha, cmap=cmap, legend=legend, ax=ax)
     plt.title(title)
+    if extent is not None:
+        ax.set_xlim(extent[0], extent[2])
+        ax.set_ylim(extent[1], extent[3])
     ax.axes.set_aspect('equal')
     if savefig:
         plt.savefig(title + '.png',bbox_inches='tight')     
         if slide_dict is not None:        
             slide_dict[title] = title + '.png' 
 
-def plotgdf_da(gdf, da, column, title,alpha=0.5, savefig=True, cmap='cetrainbow', cmap_da='cetrainbow',slide_dict=None, size=7, legend=False, robust=False):
+def plotgdf_da(gdf, da, column, title,alpha=0.5, savefig=True, cmap='cetrainbow', cmap_da='cetrainbow',slide_dict=None, size=7, legend=False, robust=False, dpi=None, extent=None, simplify=True, rasterize=False):
     """
     Plot a geodataframe with a title.
     Allow saving to a png
@@ -640,14 +798,25 @@ def plotgdf_da(gdf, da, column, title,alpha=0.5, savefig=True, cmap='cetrainbow'
         savefig: write a png to the directory
         cmap: a matplotlib colormap or a string with color_colorwanted e.g. plotgdf(da,cmap="color_white") to get a flat color gdf plot
         slide_dict: dictionary to store reference to plots in
+        dpi: dots per inch of the figure, defaults to the matplotlib figure dpi
+        extent: (minx, miny, maxx, maxy) to clip the features to, features outside it are not drawn
+        simplify: simplify geometries to one pixel at the figure size before drawing
+        rasterize: draw the features as an image at screen resolution, for dense layers
 
 
     Examples:
     
     """
-    fig, ax = plt.subplots(figsize=(size,size))
-    da.plot(ax=ax, cmap=cmap_da, robust=robust)
-    if column is not None:
+    cmap = _resolve_cmap(cmap)
+    cmap_da = _resolve_cmap(cmap_da)
+    gdf, view = _gdf_view(gdf, size, dpi=dpi, extent=extent, simplify=simplify)
+    fig, ax = plt.subplots(figsize=(size,size), dpi=dpi)
+    vmin, vmax = plot_limits(da, robust=robust)
+    da.plot(ax=ax, cmap=cmap_da, vmin=vmin, vmax=vmax)
+    if rasterize:
+        color = cmap.split('_')[-1] if "color_" in cmap else None
+        _plot_gdf_raster(gdf, column, view, size, ax, dpi=dpi, cmap=cmap, color=color, alpha=alpha, legend=legend)
+    elif column is not None:
         if "color_" in cmap:
             gdf.plot(column=column,  alpha=alpha, color=cmap.split('_')[-1], legend=legend, ax=ax)
         else:
@@ -668,7 +837,7 @@ def plotgdf_da(gdf, da, column, title,alpha=0.5, savefig=True, cmap='cetrainbow'
         if slide_dict is not None:        
             slide_dict[title] = title + '.png' 
 
-def plotmapw(da, robust=False, cmap='cetrainbow', size=6, title='Title Here', clip=None, savefig=True, slide_dict=None, vmax=None):
+def plotmapw(da, robust=False, cmap='cetrainbow', size=6, title='Title Here', clip=None, savefig=True, slide_dict=None, vmax=None, dpi=None, decimate='auto'):
     """
     Plot a dataarray with a title. Remove colorbar in the way
     Allow saving to a png
@@ -676,19 +845,22 @@ def plotmapw(da, robust=False, cmap='cetrainbow', size=6, title='Title Here', cl
 
     Args:
         da: A DataArray
+        dpi: dots per inch of the figure, defaults to the matplotlib figure dpi
+        decimate: 'mean', 'max' or 'mode' block reduction to screen resolution before plotting, 'auto' for mode
+                  on boolean or flag_values class grids and mean otherwise, None to plot every cell
 
 
     Examples:
     
     """
-    fig, ax = plt.subplots(figsize=(size,size))
-    if clip is not None:
-        quantile = np.nanpercentile(da, clip)
-        da.plot(cmap=cmap, robust=robust, ax=ax, vmax=quantile)
-    elif vmax is not None:
-        da.plot(cmap=cmap, robust=robust, ax=ax, vmax=vmax)
-    else:
-        da.plot(cmap=cmap, robust=robust, ax=ax, vmax=vmax)
+    cmap = _resolve_cmap(cmap)
+    vmin, quantile = plot_limits(da, clip=clip, robust=robust)
+    if clip is not None or vmax is None:
+        vmax = quantile
+    da = _screen_decimate(da, size, dpi=dpi, method=decimate)
+
+    fig, ax = plt.subplots(figsize=(size,size), dpi=dpi)
+    da.plot(cmap=cmap, ax=ax, vmin=vmin, vmax=vmax)
             
     plt.title(title)
     plt.gca().collections[0].colorbar.remove()
@@ -701,178 +873,1247 @@ def plotmapw(da, robust=False, cmap='cetrainbow', size=6, title='Title Here', cl
     return ax
    
         
-def mmnorm(da):
+class MapFigure:
     """
-    Minmax norm xarray DataArray
+    Reusable headless figure for rendering many maps on the same grid
+    The figure, axes, image and colorbar are made once with the Agg canvas, then each map only
+    updates the image data, colour limits and title, and the tight bounding box is worked out on
+    the first save and reused
 
     Args:
-        da: A DataArray
-
-    Returns:
-        normalised DataArray
+        da: A DataArray on the grid every map will use
+        cmap: a matplotlib colormap or name
+        size: integer size of plot
+        dpi: dots per inch of the figure, defaults to the matplotlib figure dpi
+        colorbar: add a colorbar
+        decimate: 'mean', 'max' or 'mode' block reduction to screen resolution, 'auto' for mode on boolean
+                  or flag_values class grids and mean otherwise, None to draw every cell
 
     Examples:
-        mnorm(geoscience_raster)
+        template = MapFigure(dastack[0], cmap='magma')
+        for name, da in grids.items():
+            template.render(da, name + '.png', title=name, clip=98)
     """
 
-    da_norm = (da - da.min(skipna=True))/(da.max(skipna=True) - da.min(skipna=True))
-    
-    return da_norm      
-
-
-def norm_diff_comparison(da1, da2):
+    def __init__(self, da, cmap='cetrainbow', size=6, dpi=None, colorbar=True, decimate='auto'):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        self.size = size
+        self.dpi = plt.rcParams['figure.dpi'] if dpi is None else dpi
+        self.decimate = decimate
+        self.bbox = None
+
+        values, extent, origin = self._prepare(da)
+        self.shape = values.shape
+        self.extent = extent
+
+        self.fig = Figure(figsize=(size, size), dpi=self.dpi)
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot()
+        self.image = self.ax.imshow(values, extent=extent, origin=origin, cmap=_resolve_cmap(cmap), interpolation='nearest')
+        self.ax.set_aspect('equal')
+        self.ax.set_xlabel(da.dims[-1])
+        self.ax.set_ylabel(da.dims[-2])
+        self.colorbar = self.fig.colorbar(self.image, ax=self.ax) if colorbar else None
+        self.title = self.ax.set_title('')
+
+    def _prepare(self, da):
+        """
+        Decimated values of a 2D DataArray with its imshow extent and origin
+        """
+        if 'band' in da.dims:
+            da = da.squeeze('band', drop=True)
+        da = _screen_decimate(da, self.size, dpi=self.dpi, method=self.decimate)
+        ydim, xdim = da.dims[-2:]
+        x = da[xdim].values
+        y = da[ydim].values
+        dx = abs(x[1] - x[0]) if len(x) > 1 else 1
+        dy = abs(y[1] - y[0]) if len(y) > 1 else 1
+        extent = (x.min() - dx / 2, x.max() + dx / 2, y.min() - dy / 2, y.max() + dy / 2)
+        origin = 'upper' if len(y) > 1 and y[0] > y[-1] else 'lower'
+
+        return np.asarray(da.values, dtype='float64'), extent, origin
+
+    def update(self, da, title='', vmin=None, vmax=None, clip=None, robust=False):
+        """
+        Show a new DataArray on the same grid
+
+        Args:
+            da: A DataArray on the template grid
+            title: string title of plot
+            vmin, vmax: colour limits, by default from clip and robust as in plotmap, else the data range
+            clip: percentile to clip the top of the colour scale to
+            robust: use the 2nd and 98th percentiles
+        """
+        if vmin is None or vmax is None:
+            lo, hi = plot_limits(da, clip=clip, robust=robust)
+        values, extent, _ = self._prepare(da)
+        if values.shape != self.shape or not np.allclose(extent, self.extent):
+            raise ValueError(f"DataArray grid {values.shape} does not match the template grid {self.shape}")
+
+        if vmin is None:
+            vmin = np.nanmin(values) if lo is None else lo
+        if vmax is None:
+            vmax = np.nanmax(values) if hi is None else hi
+        self.image.set_data(values)
+        self.image.set_clim(vmin, vmax)
+        self.title.set_text(title)
+
+    def save(self, path):
+        """
+        Write the current map to a png
+        """
+        if self.bbox is None:
+            from matplotlib.transforms import Bbox
+            tight = self.fig.get_tightbbox(self.fig.canvas.get_renderer()).padded(plt.rcParams['savefig.pad_inches'])
+            width = self.fig.get_figwidth()
+            self.bbox = Bbox.from_extents(min(tight.x0, 0), tight.y0, max(tight.x1, width), tight.y1)
+        self.fig.savefig(path, bbox_inches=self.bbox)
+
+        return path
+
+    def render(self, da, path, title='', **limits):
+        """
+        Update with a DataArray and write it to a png
+
+        Returns:
+            the png path
+        """
+        self.update(da, title=title, **limits)
+
+        return self.save(path)
+
+
+def _frame_rgba(template):
     """
-    Normalised difference and ratio of two xarray
+    Draw a MapFigure and copy its pixels out as an RGBA array
+    """
+    template.fig.canvas.draw()
 
-    Args:
-        da1, da2: DataArrays
+    return np.asarray(template.fig.canvas.buffer_rgba()).copy()
 
-    Returns:
-        Difference and ratio of reprojected match DataArrays
 
-    Examples:
-        norm_diff_comparison(daarea1, daarea2):
+def _encode_png(rgba, path):
     """
-
-    da1 = da1.rio.reproject_match(da2)
-    da1_norm = mmnorm(da1)
-    da2_norm = mmnorm(da2)
-    diff = da1_norm - da2_norm    
-    ratio = da1_norm / da2_norm    
-    
-    return diff, ratio
-        
-    
-def makegdf(df, xcol='longitude', ycol='latitude', crs='EPSG:4326'):
+    Write an RGBA array to a png
     """
-    Turn a dataframe of a csv of points into a geodataframe
+    from PIL import Image
+    Image.fromarray(rgba).save(path)
 
-    Args:
-        df: a dataframe from csv
-        xcol: x coordinate [longitude, easting etc.]
-        ycol: y coordinate
+    return path
 
-    Returns:
-        gdf geodataframe
 
-    Examples:
-        gdf = makegdf(df,'longitude','latitude','EPSG:4326')    
+def _quantize_frame(rgba):
+    """
+    Palette image of an RGBA array for a gif
     """
+    from PIL import Image
 
-    gdf = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df[xcol],df[ycol], crs=crs))
-    
-    return gdf
+    return Image.fromarray(rgba).convert('RGB').quantize(256)
 
 
-def df_bb(df, bb, xcol='longitude', ycol='latitude'):
+def render_stack(da, outpath, dim=None, cmap='cetrainbow', size=6, dpi=None, title='', vmin=None, vmax=None, clip=None, robust=False, fps=4, threads=None):
     """
-    Clips a dataframe of points by a bounding box
+    Render each slice of a (band, y, x) or (time, y, x) DataArray as a frame of an animation
+    Every frame is drawn on one MapFigure with one colour scale, the limits and percentiles are found together
+    in one pass over the whole stack, and frames are encoded in a thread pool while the next one is drawn
 
     Args:
-        df: a dataframe from csv
-        xcol: x coordinate [longitude, easting etc.]
-        ycol: y coordinate
-        bb: a bounding box
+        da: A 3D DataArray
+        outpath: a .gif or .mp4 path, anything else is a directory for a png sequence
+        dim: dimension to step through, defaults to the first
+        cmap: a matplotlib colormap or name
+        size: integer size of plot
+        dpi: dots per inch of the figure, defaults to the matplotlib figure dpi
+        title: string title, the slice label is added to it
+        vmin, vmax: colour limits, by default from clip and robust as in plotmap, else the stack range
+        clip: percentile to clip the top of the colour scale to
+        robust: use the 2nd and 98th percentiles
+        fps: frames per second of a gif or mp4
+        threads: number of threads encoding frames
 
     Returns:
-        df trimmed to bounding box
+        outpath for a gif or mp4, else the list of png paths
 
     Examples:
-        dfbb = df_bb(df,bb, 'longitude','latitude')    
+        render_stack(damonthly, 'ndvi.gif', dim='time', title='NDVI', robust=True)
+        pngs = render_stack(dabands, 'bands', clip=98)
     """
+    from concurrent.futures import ThreadPoolExecutor
+
+    dim = da.dims[0] if dim is None else dim
+    vmin, vmax = _color_limits(da, clip=clip, robust=robust, vmin=vmin, vmax=vmax)
+
+    template = MapFigure(da.isel({dim: 0}), cmap=cmap, size=size, dpi=dpi)
+    values = da[dim].values
+    if np.issubdtype(values.dtype, np.datetime64):
+        values = [str(pd.Timestamp(value)) for value in values]
+    labels = [f"{title} {dim} {value}".strip() for value in values]
+    outpath = str(outpath)
+    kind = os.path.splitext(outpath)[1].lower()
+
+    start = time.perf_counter()
+    if kind == '.mp4':
+        from matplotlib.animation import FFMpegWriter
+        if not FFMpegWriter.isAvailable():
+            raise ValueError("writing mp4 needs ffmpeg on the path, use a .gif or a png directory instead")
+        writer = FFMpegWriter(fps=fps)
+        with writer.saving(template.fig, outpath, template.dpi):
+            for i, label in enumerate(labels):
+                template.update(da.isel({dim: i}), title=label, vmin=vmin, vmax=vmax)
+                writer.grab_frame()
+        result = outpath
+    else:
+        if kind != '.gif':
+            os.makedirs(outpath, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = []
+            for i, label in enumerate(labels):
+                template.update(da.isel({dim: i}), title=label, vmin=vmin, vmax=vmax)
+                rgba = _frame_rgba(template)
+                if kind == '.gif':
+                    futures.append(executor.submit(_quantize_frame, rgba))
+                else:
+                    futures.append(executor.submit(_encode_png, rgba, os.path.join(outpath, f'frame_{i:04d}.png')))
+            frames = [future.result() for future in futures]
+        if kind == '.gif':
+            frames[0].save(outpath, save_all=True, append_images=frames[1:], duration=int(1000 / fps), loop=0)
+            result = outpath
+        else:
+            result = frames
 
-    dfbb = df.loc[df[xcol] > bb[0]]
-    dfbb = dfbb.loc[df[xcol] < bb[2]]
-    dfbb = dfbb.loc[df[ycol] > bb[1]]
-    dfbb = dfbb.loc[df[ycol] < bb[3]]
-    
-    return dfbb
-    
-    
-def gdf_bb(gdf, bb):
-    """
-    Returns a bounding box filtered gdf
-    
-    Args: 
-        gdf: geodataframe
-        bb: bounding box
-    """
-    gdfbb = gdf.cx[bb[0]:bb[2],bb[1]:bb[3]]
-    
-    return gdfbb
-    
+    elapsed = time.perf_counter() - start
+    print(f"rendered {len(labels)} frames in {elapsed:.1f}s ({len(labels) / max(elapsed, 1e-9):.1f} frames/s)")
 
-def gdb_dict(gdbpath):
+    return result
+
+
+def _agg_backend():
     """
-    Returns a dictionary of geodataframes
-    
-    Args: 
-        gdbpath: path to a FileGDB
+    Switch a worker process to the non interactive Agg backend
     """
-    gdb_dict = {}
-    for l in fiona.listlayers(gdbpath):
-        gdb_dict[l] = gpd.read_file(gdbpath, driver='FileGDB', layer=l)
-    
-    print(gdb_dict.keys())
-    return gdb_dict
-    
+    import matplotlib
+    matplotlib.use('Agg', force=True)
 
-def shape_dict(shapepath):
+
+def _render_worker(spec, outdir):
     """
-    Returns a dictionary of geodataframes
-    
-    Args: 
-        shapepath: path to a directory with shapefiles
+    Render one plot spec to a png and close only the figures it opened
+    The plot is started on a new figure so functions drawing on the current axes do not touch the caller's figures
     """
-    shape_dict = {}
-    for root, dirs, files in os.walk(shapepath):
-        for file in files:
-            if '.shp' in file and 'xml' not in file:
-                #print("reading: ", file
-                newfile = file.replace('.shp','')
-                shape_dict[newfile] = gpd.read_file(os.path.join(root,file))
-    
-    print(shape_dict.keys())
-    return shape_dict
+    kwargs = dict(spec)
+    func = kwargs.pop('func')
+    func = globals()[func] if isinstance(func, str) else func
+    title = kwargs['title']
+    kwargs.update(savefig=False, slide_dict=None)
+    path = os.path.join(outdir, title + '.png')
+
+    start = time.perf_counter()
+    before = set(plt.get_fignums())
+    try:
+        plt.figure()
+        func(**kwargs)
+        plt.gcf().savefig(path, bbox_inches='tight')
+    finally:
+        for num in set(plt.get_fignums()) - before:
+            plt.close(num)
 
+    return title, path, time.perf_counter() - start
 
-def zonal_stats(vector_data, measurements, dalike, variable):
+
+def render_batch(specs, outdir='.', processes=None, slide_dict=None):
     """
-    Get a dataframe of zonal statistics from a DataArray
+    Render many figures to png in parallel, e.g. to build a slide deck
+    Each spec is rendered in a worker process with the Agg backend and its figures are closed once saved,
+    so memory does not grow with the number of figures
 
     Args:
-        vector_data: a dataframe with a unique id
-        measurements: unique column of interest
-        dalike: DataArray to make grid from
-        variable: Name to give the out grid variable
+        specs: list of dicts, 'func' is a plot function or its name and the other keys are its keyword arguments,
+               'title' is required and names the png
+        outdir: directory to write the pngs to
+        processes: number of worker processes, 1 renders in this process
+        slide_dict: dictionary to add title: png path to, in the order of specs
 
     Returns:
-        zonal stats dataframe
+        slide_dict and a DataFrame of title, path and seconds for each figure
 
     Examples:
-        gdf = zonal_stats(gdf,'USEID',da,'LASERBLASTRADIUS')    
+        specs = [dict(func='plotmap', da=damag, title='Magnetics'), dict(func='plothist', da=damag, title='Magnetics histogram')]
+        slides, timings = render_batch(specs, outdir='slides', processes=8)
     """
+    start = time.perf_counter()
+    os.makedirs(outdir, exist_ok=True)
+    outdir = os.path.abspath(outdir)
+    slide_dict = {} if slide_dict is None else slide_dict
 
-    out_grid = make_geocube(
-        vector_data=vector_data,
-        measurements=[measurements],
-        like=dalike, # ensure the data are on the same grid
-        rasterize_function=partial(rasterize_image, all_touched=True)
-        
-    )
-    out_grid[variable] = (dalike.dims, dalike.values, dalike.attrs, dalike.encoding)
-    
-    grouped_da = out_grid.drop("spatial_ref").groupby(out_grid[measurements])
+    if processes == 1:
+        results = [_render_worker(spec, outdir) for spec in specs]
+    else:
+        with ProcessPoolExecutor(max_workers=processes, initializer=_agg_backend) as executor:
+            results = list(executor.map(_render_worker, specs, [outdir] * len(specs)))
 
-    grid_mean = grouped_da.mean(skipna=True)
-    grid_min = grouped_da.min(skipna=True)
-    grid_max = grouped_da.max(skipna=True)
-    grid_std = grouped_da.std(skipna=True)
-    grid_quantile = grouped_da.quantile(0.999, skipna=True)
+    for title, path, seconds in results:
+        slide_dict[title] = path
+    timings = pd.DataFrame(results, columns=['title', 'path', 'seconds'])
 
-    grid_mean = grid_mean.rename({variable: variable + "_mean"})
-    grid_max = grid_max.rename({variable: variable + "_max"})
-    grid_min = grid_min.rename({variable: variable + "_min"})
+    elapsed = time.perf_counter() - start
+    print(f"rendered {len(results)} figures in {elapsed:.1f}s ({len(results) / max(elapsed, 1e-9):.1f} figures/s)")
+
+    return slide_dict, timings
+
+
+_WEB_MERCATOR_ORIGIN = 20037508.342789244
+
+
+def _tile_resolution(zoom, tile_size=256):
+    """
+    Web mercator metres per pixel at a zoom level
+    """
+    return 2 * _WEB_MERCATOR_ORIGIN / (tile_size * 2 ** zoom)
+
+
+def _reduce_level(arr, row0, col0, method='mean'):
+    """
+    Next zoom level down by 2x2 block reduction
+    The array is padded with nan so its origin and size are even, keeping it on the tile grid
+
+    Returns:
+        reduced array and its origin in pixels of the next level
+    """
+    top, left = row0 % 2, col0 % 2
+    bottom, right = (top + arr.shape[0]) % 2, (left + arr.shape[1]) % 2
+    arr = np.pad(arr, ((top, bottom), (left, right)), constant_values=np.nan)
+    blocks = arr.reshape(arr.shape[0] // 2, 2, arr.shape[1] // 2, 2)
+
+    if method == 'mode':
+        reduced = _window_mode(blocks, axis=(1, 3))
+    elif method == 'max':
+        valid = ~np.isnan(blocks)
+        reduced = np.where(valid.any(axis=(1, 3)), np.max(np.where(valid, blocks, -np.inf), axis=(1, 3)), np.nan)
+    else:
+        count = (~np.isnan(blocks)).sum(axis=(1, 3))
+        total = np.nansum(blocks, axis=(1, 3))
+        reduced = np.where(count > 0, total / np.maximum(count, 1), np.nan)
+
+    return reduced, (row0 - top) // 2, (col0 - left) // 2
+
+
+def _render_tile(values, cmap, vmin, vmax):
+    """
+    png bytes of one tile, None when every value is nan
+    """
+    from PIL import Image
+
+    missing = np.isnan(values)
+    if missing.all():
+        return None
+    scaled = np.clip((values - vmin) / (vmax - vmin if vmax > vmin else 1), 0, 1)
+    rgba = cmap(np.where(missing, 0, scaled), bytes=True)
+    rgba[missing, 3] = 0
+
+    buffer = io.BytesIO()
+    Image.fromarray(rgba, mode='RGBA').save(buffer, format='PNG')
+
+    return buffer.getvalue()
+
+
+def _tile_bounds(zoom, x, y, tile_size=256):
+    """
+    Web mercator (minx, miny, maxx, maxy) of a tile
+    """
+    size = tile_size * _tile_resolution(zoom, tile_size)
+    left = x * size - _WEB_MERCATOR_ORIGIN
+    top = _WEB_MERCATOR_ORIGIN - y * size
+
+    return left, top - size, left + size, top
+
+
+def _warp_tile(da, zoom, x, y, tile_size=256, dtype='float32'):
+    """
+    Values of one tile reprojected from only the window of the DataArray under it
+    dask backed arrays only compute that window, None when the tile has no data
+    """
+    from rasterio.warp import reproject, transform_bounds
+
+    left, bottom, right, top = _tile_bounds(zoom, x, y, tile_size)
+    xres, yres = (abs(r) for r in da.rio.resolution())
+    src_left, src_bottom, src_right, src_top = transform_bounds('EPSG:3857', da.rio.crs, left, bottom, right, top)
+    try:
+        # one extra source cell around the tile for the edge pixels
+        window = _bounds_window(da, (src_left - xres, src_bottom - yres, src_right + xres, src_top + yres))
+    except NoDataInBounds:
+        return None
+
+    sub = da.rio.isel_window(window)
+    values = np.asarray(sub.values, dtype=dtype)
+    nodata = da.rio.nodata
+    if nodata is not None and not np.isnan(nodata):
+        values[values == nodata] = np.nan
+
+    res = _tile_resolution(zoom, tile_size)
+    out = np.full((tile_size, tile_size), np.nan, dtype=dtype)
+    reproject(
+        values,
+        out,
+        src_transform=sub.rio.transform(),
+        src_crs=da.rio.crs,
+        src_nodata=np.nan,
+        dst_transform=Affine(res, 0, left, 0, -res, top),
+        dst_crs='EPSG:3857',
+        dst_nodata=np.nan,
+    )
+
+    return None if np.isnan(out).all() else out
+
+
+def _reduce_tile(children, method='mean'):
+    """
+    Parent tile from its four children in nw, ne, sw, se order by 2x2 block reduction, None children are empty
+    """
+    present = [c for c in children if c is not None]
+    if not present:
+        return None
+    empty = np.full_like(present[0], np.nan)
+    nw, ne, sw, se = [empty if c is None else c for c in children]
+    reduced = _reduce_level(np.block([[nw, ne], [sw, se]]), 0, 0, method=method)[0]
+
+    return reduced.astype(present[0].dtype, copy=False)
+
+
+def _color_limits(da, clip=None, robust=False, vmin=None, vmax=None, sample=1_000_000):
+    """
+    Colour limits for a whole grid or stack, clip and robust percentiles filled in with the data range
+    The min, max and a strided sample for the percentiles are computed together,
+    so a dask backed array is read once
+    """
+    if vmin is not None and vmax is not None:
+        return vmin, vmax
+
+    q = []
+    if robust:
+        q.append(2.0)
+    if clip is not None:
+        q.append(float(clip))
+    elif robust:
+        q.append(98.0)
+
+    # only the last two (spatial) dims are strided so every band or time step of a stack is sampled
+    nspatial = min(da.ndim, 2)
+    step = max(int(np.ceil((da.size / sample) ** (1 / max(nspatial, 1)))), 1)
+    reductions = [da.min(skipna=True).data, da.max(skipna=True).data]
+    if q:
+        index = (slice(None),) * (da.ndim - nspatial) + (slice(None, None, step),) * nspatial
+        reductions.append(da.data[index])
+    if _is_dask(da):
+        import dask
+        reductions = dask.compute(*reductions)
+
+    lo, hi = float(reductions[0]), float(reductions[1])
+    if q:
+        percentiles = np.nanpercentile(np.asarray(reductions[2], dtype='float64').ravel(), q)
+        hi = float(percentiles[-1])
+        lo = float(percentiles[0]) if robust else lo
+
+    return (lo if vmin is None else vmin), (hi if vmax is None else vmax)
+
+
+def export_tiles(da, outpath, cmap='cetrainbow', vmin=None, vmax=None, clip=None, robust=False, min_zoom=None, max_zoom=None, method='mean', tile_size=256, threads=None):
+    """
+    Render a DataArray into a web map tile pyramid viewable in a browser
+    Tiles at the highest zoom are reprojected one at a time from the window of the grid under them, and each
+    lower zoom tile is built from its four children by 2x2 block reduction, so only a few tiles are ever held
+    in memory and dask backed arrays stay lazy. Subtrees of the pyramid are rendered in parallel and tiles
+    with no data are not written.
+
+    Args:
+        da: A 2D DataArray with a crs
+        outpath: directory for z/x/y.png tiles, or a path ending in .mbtiles for a single file archive
+        cmap: a matplotlib colormap or name
+        vmin, vmax: colour limits, by default from clip and robust as in plotmap, else the data range
+        clip: percentile to clip the top of the colour scale to
+        robust: use the 2nd and 98th percentiles
+        min_zoom: lowest zoom level, defaults to where the grid fits in about one tile
+        max_zoom: highest zoom level, defaults to the first with pixels no larger than the grid cells
+        method: 'mean', 'max' or 'mode' reduction between zoom levels
+        tile_size: tile width and height in pixels
+        threads: number of threads rendering tiles
+
+    Returns:
+        number of tiles written
+
+    Examples:
+        export_tiles(damag, 'tiles/magnetics', clip=98)
+        export_tiles(dageology, 'geology.mbtiles', cmap='tab20', method='mode')
+    """
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from rasterio.warp import calculate_default_transform, transform_bounds
+
+    start = time.perf_counter()
+    cmap = _resolve_cmap(cmap)
+    cmap = matplotlib.colormaps[cmap] if isinstance(cmap, str) else cmap
+
+    if 'band' in da.dims:
+        da = da.squeeze('band', drop=True)
+    vmin, vmax = _color_limits(da, clip=clip, robust=robust, vmin=vmin, vmax=vmax)
+    dtype = np.result_type(da.dtype, np.float32)
+
+    bounds = da.rio.bounds()
+    if max_zoom is None:
+        native, _, _ = calculate_default_transform(da.rio.crs, 'EPSG:3857', da.rio.width, da.rio.height, *bounds)
+        max_zoom = int(np.ceil(np.log2(_tile_resolution(0, tile_size) / native.a)))
+    minx, miny, maxx, maxy = transform_bounds(da.rio.crs, 'EPSG:3857', *bounds)
+    if min_zoom is None:
+        pixels = max(maxx - minx, maxy - miny) / _tile_resolution(max_zoom, tile_size)
+        min_zoom = max(max_zoom - int(np.ceil(np.log2(max(pixels, 1) / tile_size))), 0)
+    if min_zoom > max_zoom:
+        raise ValueError(f"min_zoom {min_zoom} is above max_zoom {max_zoom}")
+
+    def covering(zoom):
+        """Tiles at a zoom level that overlap the grid"""
+        size = tile_size * _tile_resolution(zoom, tile_size)
+        xs = range(int((minx + _WEB_MERCATOR_ORIGIN) // size), int(np.ceil((maxx + _WEB_MERCATOR_ORIGIN) / size)))
+        ys = range(int((_WEB_MERCATOR_ORIGIN - maxy) // size), int(np.ceil((_WEB_MERCATOR_ORIGIN - miny) / size)))
+        return [(x, y) for y in ys for x in xs]
+
+    mbtiles = str(outpath).endswith('.mbtiles')
+    lock = threading.Lock()
+    written = [0]
+    db = None
+
+    def write(zoom, x, y, values):
+        """Render and store one tile"""
+        png = _render_tile(values, cmap, vmin, vmax)
+        if png is None:
+            return
+        if mbtiles:
+            with lock:
+                db.execute('INSERT INTO tiles VALUES (?, ?, ?, ?)', (zoom, x, 2 ** zoom - 1 - y, png))
+        else:
+            path = os.path.join(outpath, str(zoom), str(x))
+            os.makedirs(path, exist_ok=True)
+            with open(os.path.join(path, f'{y}.png'), 'wb') as f:
+                f.write(png)
+        with lock:
+            written[0] += 1
+
+    def tile_tree(zoom, x, y):
+        """Values of a tile, writing every tile of its subtree on the way up"""
+        left, bottom, right, top = _tile_bounds(zoom, x, y, tile_size)
+        if left >= maxx or right <= minx or bottom >= maxy or top <= miny:
+            return None
+        if zoom == max_zoom:
+            values = _warp_tile(da, zoom, x, y, tile_size=tile_size, dtype=dtype)
+        else:
+            children = [tile_tree(zoom + 1, 2 * x + dx, 2 * y + dy) for dy in (0, 1) for dx in (0, 1)]
+            values = _reduce_tile(children, method=method)
+        if values is not None:
+            write(zoom, x, y, values)
+        return values
+
+    try:
+        if mbtiles:
+            import sqlite3
+            if os.path.exists(outpath):
+                os.remove(outpath)
+            db = sqlite3.connect(outpath, check_same_thread=False)
+            db.execute('CREATE TABLE metadata (name TEXT, value TEXT)')
+            db.execute('CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)')
+            lonlat = transform_bounds(da.rio.crs, 'EPSG:4326', *bounds)
+            metadata = dict(
+                name=str(da.name or os.path.basename(str(outpath))),
+                format='png',
+                type='overlay',
+                bounds=','.join(f'{b:.6f}' for b in lonlat),
+                minzoom=str(min_zoom),
+                maxzoom=str(max_zoom),
+            )
+            db.executemany('INSERT INTO metadata VALUES (?, ?)', metadata.items())
+
+        # split the pyramid into enough subtrees to keep every thread busy
+        workers = threads or min(32, (os.cpu_count() or 1) + 4)
+        split = min_zoom
+        while split < max_zoom and len(covering(split)) < 4 * workers:
+            split += 1
+        tiles = covering(split)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            level = dict(zip(tiles, executor.map(lambda tile: tile_tree(split, *tile), tiles)))
+
+        for zoom in range(split - 1, min_zoom - 1, -1):
+            parents = {}
+            for x, y in covering(zoom):
+                children = [level.get((2 * x + dx, 2 * y + dy)) for dy in (0, 1) for dx in (0, 1)]
+                parents[(x, y)] = _reduce_tile(children, method=method)
+                if parents[(x, y)] is not None:
+                    write(zoom, x, y, parents[(x, y)])
+            level = parents
+
+        if mbtiles:
+            db.execute('CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)')
+            db.commit()
+    finally:
+        if db is not None:
+            db.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"wrote {written[0]} tiles for zoom {min_zoom}-{max_zoom} in {elapsed:.1f}s ({written[0] / max(elapsed, 1e-9):.1f} tiles/s)")
+
+    return written[0]
+
+
+def _is_dask(da):
+    """
+    True if a DataArray is backed by a dask array
+    """
+    return hasattr(da.data, "__dask_graph__")
+
+
+def _minmax(*das):
+    """
+    nan skipping minimum and maximum of each DataArray
+    For dask backed arrays all reductions are computed together so each chunk is read once
+
+    Returns:
+        list of (min, max) tuples
+    """
+    reductions = []
+    for da in das:
+        reductions.extend([da.min(skipna=True), da.max(skipna=True)])
+
+    if any(_is_dask(da) for da in das):
+        import dask
+        reductions = dask.compute(*reductions)
+
+    values = [float(r) for r in reductions]
+
+    return list(zip(values[0::2], values[1::2]))
+
+
+def _histogram(da, edges):
+    """
+    Counts of a DataArray in bins, streamed over dask chunks, nan and out of range values are ignored
+    """
+    if _is_dask(da):
+        import dask.array as dsa
+        counts, _ = dsa.histogram(da.data, bins=edges)
+        return counts.compute()
+
+    counts, _ = np.histogram(np.asarray(da.data).ravel(), bins=edges)
+
+    return counts
+
+
+def _approx_percentiles(da, q, bins=4096, limits=None):
+    """
+    Percentiles from a histogram sketch of a DataArray instead of a full sort
+    The error is at most the width of one bin, (max - min) / bins
+
+    Args:
+        da: A DataArray
+        q: percentiles between 0 and 100
+        bins: number of histogram bins
+        limits: (min, max) if already known
+
+    Returns:
+        numpy array of the percentile values
+    """
+    lo, hi = _minmax(da)[0] if limits is None else limits
+    if not np.isfinite(lo) or hi <= lo:
+        return np.full(len(np.atleast_1d(q)), lo)
+
+    edges = np.linspace(lo, hi, bins + 1)
+    cdf = np.concatenate([[0], np.cumsum(_histogram(da, edges))])
+
+    return np.interp(np.asarray(q, dtype='float64') / 100 * cdf[-1], cdf, edges)
+
+
+def _norm_limits(das, percentiles=None, bins=4096):
+    """
+    Normalisation (low, high) for each DataArray, min/max or approximate percentiles
+    """
+    limits = _minmax(*das)
+    if percentiles is None:
+        return limits
+
+    return [tuple(_approx_percentiles(da, percentiles, bins=bins, limits=lim)) for da, lim in zip(das, limits)]
+
+
+def mmnorm(da, percentiles=None, bins=4096):
+    """
+    Minmax norm xarray DataArray
+    min and max are found in one pass and dask backed arrays stay lazy
+
+    Args:
+        da: A DataArray
+        percentiles: optional (low, high) percentiles e.g. (2, 98) to normalise to instead of min/max,
+                     estimated from a streaming histogram and clipped to 0-1
+        bins: histogram bins for the percentiles, the error is at most (max - min) / bins
+
+    Returns:
+        normalised DataArray
+
+    Examples:
+        mnorm(geoscience_raster)
+        mnorm(geoscience_raster, percentiles=(2, 98))
+    """
+
+    lo, hi = _norm_limits([da], percentiles=percentiles, bins=bins)[0]
+    da_norm = (da - lo)/(hi - lo)
+    if percentiles is not None:
+        da_norm = da_norm.clip(0, 1)
+    
+    return da_norm      
+
+
+def _norm_diff_ratio(a, b, lo1, range1, lo2, range2, clip):
+    """
+    Normalised difference and ratio of two arrays in one pass over a chunk
+    """
+    a = (a - lo1) / range1
+    b = (b - lo2) / range2
+    if clip:
+        np.clip(a, 0, 1, out=a)
+        np.clip(b, 0, 1, out=b)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = a / b
+    a -= b
+
+    return a, ratio
+
+
+def norm_diff_comparison(da1, da2, percentiles=None, bins=4096):
+    """
+    Normalised difference and ratio of two xarray
+    da1 is only reprojected when it is not already on the grid of da2, the normalisation
+    limits of both are found together and diff and ratio come from one fused computation
+    that stays lazy and chunked for dask backed arrays
+
+    Args:
+        da1, da2: DataArrays
+        percentiles: optional (low, high) percentiles to normalise to, see mmnorm
+        bins: histogram bins for the percentiles
+
+    Returns:
+        Difference and ratio of reprojected match DataArrays
+
+    Examples:
+        norm_diff_comparison(daarea1, daarea2):
+    """
+
+    same_grid = (
+        da1.rio.shape == da2.rio.shape
+        and da1.rio.transform() == da2.rio.transform()
+        and da1.rio.crs == da2.rio.crs
+    )
+    if not same_grid:
+        da1 = da1.rio.reproject_match(da2)
+
+    (lo1, hi1), (lo2, hi2) = _norm_limits([da1, da2], percentiles=percentiles, bins=bins)
+    dtype = np.result_type(da1.dtype, da2.dtype, np.float32)
+
+    diff, ratio = xr.apply_ufunc(
+        _norm_diff_ratio,
+        da1,
+        da2,
+        kwargs=dict(lo1=lo1, range1=hi1 - lo1, lo2=lo2, range2=hi2 - lo2, clip=percentiles is not None),
+        output_core_dims=[[], []],
+        dask='parallelized',
+        output_dtypes=[dtype, dtype],
+        join='override',
+    )
+    
+    return diff, ratio
+        
+    
+def makegdf(df, xcol='longitude', ycol='latitude', crs='EPSG:4326'):
+    """
+    Turn a dataframe of a csv of points into a geodataframe
+
+    Args:
+        df: a dataframe from csv
+        xcol: x coordinate [longitude, easting etc.]
+        ycol: y coordinate
+
+    Returns:
+        gdf geodataframe
+
+    Examples:
+        gdf = makegdf(df,'longitude','latitude','EPSG:4326')    
+    """
+
+    gdf = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df[xcol],df[ycol], crs=crs))
+    
+    return gdf
+
+
+def _bb_mask(x, y, bb):
+    """
+    Single boolean mask of points strictly inside a bounding box, combined in place
+    """
+    mask = x > bb[0]
+    mask &= x < bb[2]
+    mask &= y > bb[1]
+    mask &= y < bb[3]
+
+    return mask
+
+
+_BB_INDEX_CACHE = {}
+
+
+def _sorted_index(df, xcol, ycol):
+    """
+    x sorted order of the points in a dataframe, cached for repeated bounding box queries
+    The cache entry is dropped when the dataframe is garbage collected
+
+    Returns:
+        order, sorted x and y in x sorted order
+    """
+    key = (id(df), xcol, ycol)
+    cached = _BB_INDEX_CACHE.get(key)
+    if cached is not None and cached[0]() is df and cached[1] == len(df):
+        return cached[2:]
+
+    x = df[xcol].to_numpy()
+    order = np.argsort(x, kind='stable')
+    xsorted = x[order]
+    ysorted = df[ycol].to_numpy()[order]
+
+    ref = weakref.ref(df, lambda ref, key=key: _BB_INDEX_CACHE.pop(key, None))
+    _BB_INDEX_CACHE[key] = (ref, len(df), order, xsorted, ysorted)
+
+    return order, xsorted, ysorted
+
+
+def _sorted_query(index, bb):
+    """
+    Positional rows inside a bounding box from a sorted coordinate index
+    """
+    order, xsorted, ysorted = index
+    lo = np.searchsorted(xsorted, bb[0], side='right')
+    hi = np.searchsorted(xsorted, bb[2], side='left')
+    inside = (ysorted[lo:hi] > bb[1]) & (ysorted[lo:hi] < bb[3])
+
+    return np.sort(order[lo:hi][inside])
+
+
+def df_bb(df, bb, xcol='longitude', ycol='latitude', index=False):
+    """
+    Clips a dataframe of points by a bounding box
+    One combined mask is built from the coordinate arrays and applied once
+
+    Args:
+        df: a dataframe from csv
+        xcol: x coordinate [longitude, easting etc.]
+        ycol: y coordinate
+        bb: a bounding box
+        index: build and cache a sorted coordinate index for a frame that is filtered repeatedly
+               the frame should not be modified in place while the index is in use
+
+    Returns:
+        df trimmed to bounding box
+
+    Examples:
+        dfbb = df_bb(df,bb, 'longitude','latitude')    
+        dfbb = df_bb(df,bb, 'longitude','latitude', index=True)    
+    """
+
+    if index:
+        rows = _sorted_query(_sorted_index(df, xcol, ycol), bb)
+        return df.iloc[rows]
+
+    mask = _bb_mask(df[xcol].to_numpy(), df[ycol].to_numpy(), bb)
+    dfbb = df[mask]
+    
+    return dfbb
+
+
+def bb_ids(df, bbs, xcol='longitude', ycol='latitude', index=False):
+    """
+    Returns the id of the bounding box each point falls in
+    Where boxes overlap the first box in the list wins
+
+    Args:
+        df: a dataframe from csv
+        bbs: list of bounding boxes
+        xcol: x coordinate [longitude, easting etc.]
+        ycol: y coordinate
+        index: use a cached sorted coordinate index, see df_bb
+
+    Returns:
+        numpy array with the box position for each row, -1 if in no box
+
+    Examples:
+        ids = bb_ids(df, [bb1, bb2], 'longitude','latitude')    
+    """
+
+    ids = np.full(len(df), -1, dtype=np.int64)
+    if index:
+        sorted_index = _sorted_index(df, xcol, ycol)
+    else:
+        x = df[xcol].to_numpy()
+        y = df[ycol].to_numpy()
+
+    # assign in reverse so the first box is written last
+    for i in range(len(bbs) - 1, -1, -1):
+        if index:
+            ids[_sorted_query(sorted_index, bbs[i])] = i
+        else:
+            ids[_bb_mask(x, y, bbs[i])] = i
+
+    return ids
+
+
+def df_bb_many(df, bbs, xcol='longitude', ycol='latitude', id_col='bb_id', index=False):
+    """
+    Clips a dataframe of points by many bounding boxes at once
+
+    Args:
+        df: a dataframe from csv
+        bbs: list of bounding boxes
+        xcol: x coordinate [longitude, easting etc.]
+        ycol: y coordinate
+        id_col: name of the column to store the box position in
+        index: use a cached sorted coordinate index, see df_bb
+
+    Returns:
+        df trimmed to the points inside any box with the box id of each row
+
+    Examples:
+        dfbb = df_bb_many(df, [bb1, bb2], 'longitude','latitude')    
+    """
+
+    ids = bb_ids(df, bbs, xcol=xcol, ycol=ycol, index=index)
+    inside = ids >= 0
+    dfbb = df[inside].assign(**{id_col: ids[inside]})
+
+    return dfbb
+    
+    
+def gdf_bb(gdf, bb):
+    """
+    Returns a bounding box filtered gdf
+    Uses the geodataframe spatial index, which is built once and cached on the frame
+    
+    Args: 
+        gdf: geodataframe
+        bb: bounding box
+    """
+    rows = gdf.sindex.query(box(bb[0], bb[1], bb[2], bb[3]), predicate='intersects')
+    gdfbb = gdf.iloc[np.sort(rows)]
+    
+    return gdfbb
+
+
+def gdf_bb_many(gdf, bbs, id_col='bb_id'):
+    """
+    Returns a gdf filtered by many bounding boxes with the id of the box for each row
+    Where boxes overlap the first box in the list wins
+    
+    Args: 
+        gdf: geodataframe
+        bbs: list of bounding boxes
+        id_col: name of the column to store the box position in
+    """
+    boxes = np.array([box(bb[0], bb[1], bb[2], bb[3]) for bb in bbs])
+    box_idx, rows = gdf.sindex.query(boxes, predicate='intersects')
+
+    order = np.lexsort((box_idx, rows))
+    rows, first = np.unique(rows[order], return_index=True)
+    gdfbb = gdf.iloc[rows].assign(**{id_col: box_idx[order][first]})
+    
+    return gdfbb
+    
+
+def _row_group_outside(metadata, xcol, ycol, bb):
+    """
+    True when the row group x/y statistics show no point can fall inside the bounding box
+    """
+    limits = {}
+    for j in range(metadata.num_columns):
+        column = metadata.column(j)
+        if column.path_in_schema in (xcol, ycol):
+            stats = column.statistics
+            if stats is None or not stats.has_min_max:
+                return False
+            limits[column.path_in_schema] = (stats.min, stats.max)
+
+    if xcol not in limits or ycol not in limits:
+        return False
+
+    xmin, xmax = limits[xcol]
+    ymin, ymax = limits[ycol]
+
+    return xmax <= bb[0] or xmin >= bb[2] or ymax <= bb[1] or ymin >= bb[3]
+
+
+def _iter_point_chunks(inpath, xcol, ycol, bb, chunksize, columns, **read_kwargs):
+    """
+    Yields dataframes from a csv in chunks or a parquet file by row group
+    Parquet row groups whose statistics lie outside the bounding box are not read
+    """
+    if os.path.splitext(inpath)[1].lower() in ('.parquet', '.pq', '.geoparquet'):
+        import pyarrow.parquet as pq
+
+        pf = pq.ParquetFile(inpath)
+        read = 0
+        for i in range(pf.num_row_groups):
+            if bb is not None and _row_group_outside(pf.metadata.row_group(i), xcol, ycol, bb):
+                continue
+            read += 1
+            yield pf.read_row_group(i, columns=columns).to_pandas()
+
+        if read == 0:
+            yield pf.schema_arrow.empty_table().to_pandas()
+        print(f"read {read} of {pf.num_row_groups} row groups")
+    else:
+        yield from pd.read_csv(inpath, chunksize=chunksize, usecols=columns, **read_kwargs)
+
+
+def _geoparquet_metadata(crs):
+    """
+    GeoParquet metadata for a WKB point geometry column
+    """
+    geo = {
+        "version": "1.0.0",
+        "primary_column": "geometry",
+        "columns": {"geometry": {"encoding": "WKB", "geometry_types": ["Point"], "crs": CRS.from_user_input(crs).to_json_dict()}},
+    }
+
+    return json.dumps(geo).encode()
+
+
+def _points_table(chunk, xcol, ycol, crs, geometry):
+    """
+    Arrow table of a chunk of points, with a WKB point geometry column for geoparquet
+    Columns with no values in the chunk are typed null so they take the type of the other chunks
+    """
+    import pyarrow as pa
+
+    if geometry:
+        gdf = makegdf(chunk, xcol, ycol, crs)
+        chunk = pd.DataFrame(gdf.drop(columns='geometry'))
+    table = pa.Table.from_pandas(chunk, preserve_index=False)
+    if len(table):
+        for i, field in enumerate(table.schema):
+            if table.column(i).null_count == len(table):
+                table = table.set_column(i, pa.field(field.name, pa.null()), pa.nulls(len(table)))
+    if geometry:
+        table = table.append_column('geometry', pa.array(gdf.geometry.to_wkb(), type=pa.binary()))
+
+    return table
+
+
+def _points_schema(schema, table):
+    """
+    Schema that both the rows written so far and a new chunk fit
+    Integers are promoted to float and null columns to the type of the other, columns that are
+    numbers in one chunk and text in another become strings
+    """
+    import pyarrow as pa
+
+    try:
+        return pa.unify_schemas([schema, table.schema], promote_options='permissive')
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        pass
+
+    fields = []
+    for field in schema:
+        other = table.schema.field(field.name)
+        try:
+            fields.append(pa.unify_schemas([pa.schema([field]), pa.schema([other])], promote_options='permissive').field(0))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            fields.append(pa.field(field.name, pa.string()))
+
+    return pa.schema(fields, metadata=schema.metadata)
+
+
+def _points_writer(outpath, schema, crs, geometry):
+    """
+    Parquet writer for a schema, plus geoparquet metadata
+    """
+    import pyarrow.parquet as pq
+
+    if geometry:
+        schema = schema.with_metadata({**(schema.metadata or {}), b'geo': _geoparquet_metadata(crs)})
+
+    return pq.ParquetWriter(outpath, schema)
+
+
+def _promote_points(writer, outpath, schema, crs, geometry):
+    """
+    Closes a parquet writer and rewrites what it wrote row group by row group with a promoted schema,
+    returning a writer that appends to the rewritten file
+    """
+    import pyarrow.parquet as pq
+
+    writer.close()
+    tmppath = f"{outpath}.promote"
+    os.replace(outpath, tmppath)
+    writer = _points_writer(outpath, schema, crs, geometry)
+    try:
+        with pq.ParquetFile(tmppath) as pf:
+            for i in range(pf.num_row_groups):
+                writer.write_table(pf.read_row_group(i).cast(writer.schema))
+    except BaseException:
+        writer.close()
+        raise
+    os.remove(tmppath)
+
+    return writer
+
+
+def stream_bb(inpath, outpath, bb=None, polygon=None, xcol='longitude', ycol='latitude', crs='EPSG:4326', geometry=True, chunksize=1_000_000, columns=None, **read_kwargs):
+    """
+    Filters a huge csv or parquet point file to a bounding box or polygon chunk by chunk
+    and writes the result to (geo)parquet, so only one chunk is ever held in memory
+    A column whose type changes between chunks is promoted, ints to float and numbers mixed with text to strings,
+    pass dtype= in read_kwargs to fix csv column types up front
+    
+    Args:
+        inpath: path to a csv or parquet file of points
+        outpath: path of the parquet file to write
+        bb: a bounding box
+        polygon: a shapely polygon or a geodataframe of polygons to keep points inside
+        xcol: x coordinate [longitude, easting etc.]
+        ycol: y coordinate
+        crs: crs of the point coordinates
+        geometry: build point geometry with makegdf and write geoparquet, otherwise plain parquet
+        chunksize: rows per csv chunk, parquet is read by row group
+        columns: optional list of columns to read
+        read_kwargs: passed to pandas.read_csv
+        
+    Returns:
+        number of rows written
+        
+    Examples:
+        stream_bb('geochem.csv', 'geochem_bb.parquet', bb=[115, -35, 125, -25])
+        stream_bb('lidar.parquet', 'lidar_tenement.parquet', polygon=gdf_tenement, xcol='X', ycol='Y', crs='EPSG:28350')
+    """
+
+    if polygon is not None:
+        if isinstance(polygon, (gpd.GeoDataFrame, gpd.GeoSeries)):
+            if polygon.crs is not None:
+                polygon = polygon.to_crs(crs)
+            polygon = shapely.union_all(np.asarray(polygon.geometry.values))
+        shapely.prepare(polygon)
+        pbb = polygon.bounds
+        bb = pbb if bb is None else [max(bb[0], pbb[0]), max(bb[1], pbb[1]), min(bb[2], pbb[2]), min(bb[3], pbb[3])]
+
+    if columns is not None:
+        columns = list(columns) + [c for c in (xcol, ycol) if c not in columns]
+
+    start = time.perf_counter()
+    writer = None
+    nread = 0
+    nwritten = 0
+    try:
+        for chunk in _iter_point_chunks(inpath, xcol, ycol, bb, chunksize, columns, **read_kwargs):
+            nread += len(chunk)
+            x = chunk[xcol].to_numpy()
+            y = chunk[ycol].to_numpy()
+            if bb is not None:
+                mask = _bb_mask(x, y, bb)
+                chunk, x, y = chunk[mask], x[mask], y[mask]
+            if polygon is not None:
+                chunk = chunk[shapely.contains_xy(polygon, x, y)]
+
+            table = _points_table(chunk, xcol, ycol, crs, geometry)
+            if writer is None:
+                writer = _points_writer(outpath, table.schema, crs, geometry)
+            else:
+                # a column whose type changed between chunks, e.g. ints then floats, rewrites the rows written so far
+                schema = _points_schema(writer.schema, table)
+                if not schema.equals(writer.schema):
+                    writer = _promote_points(writer, outpath, schema, crs, geometry)
+            writer.write_table(table.cast(writer.schema))
+            nwritten += len(table)
+
+        if writer is None:
+            empty = pd.DataFrame({c: pd.Series(dtype='float64') for c in (columns or [xcol, ycol])})
+            writer = _points_writer(outpath, _points_table(empty, xcol, ycol, crs, geometry).schema, crs, geometry)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"kept {nwritten} of {nread} points in {elapsed:.1f}s ({nread / max(elapsed, 1e-9):.0f} points/s)")
+
+    return nwritten
+
+
+def gdb_dict(gdbpath):
+    """
+    Returns a dictionary of geodataframes
+    
+    Args: 
+        gdbpath: path to a FileGDB
+    """
+    gdb_dict = {}
+    for l in fiona.listlayers(gdbpath):
+        gdb_dict[l] = gpd.read_file(gdbpath, driver='FileGDB', layer=l)
+    
+    print(gdb_dict.keys())
+    return gdb_dict
+    
+
+def shape_dict(shapepath):
+    """
+    Returns a dictionary of geodataframes
+    
+    Args: 
+        shapepath: path to a directory with shapefiles
+    """
+    shape_dict = {}
+    for root, dirs, files in os.walk(shapepath):
+        for file in files:
+            if '.shp' in file and 'xml' not in file:
+                #print("reading: ", file
+                newfile = file.replace('.shp','')
+                shape_dict[newfile] = gpd.read_file(os.path.join(root,file))
+    
+    print(shape_dict.keys())
+    return shape_dict
+
+
+def zonal_stats(vector_data, measurements, dalike, variable):
+    """
+    Get a dataframe of zonal statistics from a DataArray
+
+    Args:
+        vector_data: a dataframe with a unique id
+        measurements: unique column of interest
+        dalike: DataArray to make grid from
+        variable: Name to give the out grid variable
+
+    Returns:
+        zonal stats dataframe
+
+    Examples:
+        gdf = zonal_stats(gdf,'USEID',da,'LASERBLASTRADIUS')    
+    """
+
+    out_grid = make_geocube(
+        vector_data=vector_data,
+        measurements=[measurements],
+        like=dalike, # ensure the data are on the same grid
+        rasterize_function=partial(rasterize_image, all_touched=True)
+        
+    )
+    out_grid[variable] = (dalike.dims, dalike.values, dalike.attrs, dalike.encoding)
+    
+    grouped_da = out_grid.drop("spatial_ref").groupby(out_grid[measurements])
+
+    grid_mean = grouped_da.mean(skipna=True)
+    grid_min = grouped_da.min(skipna=True)
+    grid_max = grouped_da.max(skipna=True)
+    grid_std = grouped_da.std(skipna=True)
+    grid_quantile = grouped_da.quantile(0.999, skipna=True)
+
+    grid_mean = grid_mean.rename({variable: variable + "_mean"})
+    grid_max = grid_max.rename({variable: variable + "_max"})
+    grid_min = grid_min.rename({variable: variable + "_min"})
     grid_std = grid_std.rename({variable: variable + "__std"})
     grid_quantile = grid_quantile.rename({variable: variable + "_quantile999"})
     
@@ -1343,13 +2584,73 @@ def tif_to_img(strpath, masked=True, chunks=None, dsmatch=None):
     return check_dict
      
 
-def clip_da(da, gdfpath):
+def _read_polygons(gdfpath):
+    """
+    Returns a geodataframe from a path, passing geodataframes straight through
+    """
+    if isinstance(gdfpath, gpd.GeoDataFrame):
+        return gdfpath
+
+    return gpd.read_file(gdfpath)
+
+
+def _bounds_window(da, bounds):
+    """
+    Integer pixel window of a DataArray covering bounds, limited to the raster extent
+
+    Args:
+        da: rioxarray Data Array
+        bounds: xmin, ymin, xmax, ymax in the raster crs
+
+    Returns:
+        rasterio Window
+    """
+    return _pixel_window(da.rio.transform(), da.rio.shape, bounds)
+
+
+def _pixel_window(transform, shape, bounds):
+    """
+    Integer pixel window covering bounds for a raster transform and (height, width) shape
+    """
+    height, width = shape
+    window = rasterio.windows.from_bounds(*bounds, transform=transform)
+
+    col0 = max(int(math.floor(window.col_off)), 0)
+    row0 = max(int(math.floor(window.row_off)), 0)
+    col1 = min(int(math.ceil(window.col_off + window.width)), width)
+    row1 = min(int(math.ceil(window.row_off + window.height)), height)
+
+    if col1 <= col0 or row1 <= row0:
+        raise NoDataInBounds("No data found in bounds of the polygons")
+
+    return rasterio.windows.Window(col0, row0, col1 - col0, row1 - row0)
+
+
+def _clip_window(da, gdf, all_touched=False):
+    """
+    Clips a DataArray by polygons after slicing it down to the polygon envelope,
+    so only that window is read and the mask is only rasterized within it
+    """
+    if da.rio.crs is not None and gdf.crs is not None and gdf.crs != da.rio.crs:
+        bounds = gdf.to_crs(da.rio.crs).total_bounds
+    else:
+        bounds = gdf.total_bounds
+
+    window = da.rio.isel_window(_bounds_window(da, bounds))
+    clipped = window.rio.clip(gdf.geometry.values, gdf.crs, drop=True, invert=False, all_touched=all_touched)
+
+    return clipped
+
+
+def clip_da(da, gdfpath, all_touched=False):
     """
     Clips a rioxarray raster by geodataframe polygons
+    Only the window covering the polygons is read from a lazily opened raster
     
     Args:
         da: rioxarray Data Array
-        gdfpath: Path to vector polygon dataset
+        gdfpath: Path to vector polygon dataset or a geodataframe
+        all_touched: include all pixels touched by the polygons
     
     Returns:
         Clipped rioxarray
@@ -1359,33 +2660,232 @@ def clip_da(da, gdfpath):
     
     """
 
-    gdf = gpd.read_file(gdfpath)
-    clipped = da.rio.clip(gdf.geometry.values, gdf.crs, drop=True, invert=False)
+    gdf = _read_polygons(gdfpath)
+    clipped = _clip_window(da, gdf, all_touched=all_touched)
     
     return clipped
 
 
-def clip_raster(dapath, gdfpath):
+def clip_raster(dapath, gdfpath, masked=False, chunks=None, all_touched=False):
     """
     Clips a rioxarray by geodataframe polygons
+    The raster is opened lazily and only the polygon envelope window is read
     
     Args:
         dapath: Path to raster
-        gdfpath: Path to vector polygon dataset
+        gdfpath: Path to vector polygon dataset or a geodataframe
+        masked: whether to mask by nodata
+        chunks: optional dask chunks to open the raster with
+        all_touched: include all pixels touched by the polygons
     
     Returns:
         Clipped rioxarray
         
     Examples: 
-        schaus = clip_da('dapath', 'gdfpath')
+        schaus = clip_raster('dapath', 'gdfpath')
     
     """
 
-    da = rioxarray.open_rasterio(dapath)
-    gdf = gpd.read_file(gdfpath)
-    clipped = da.rio.clip(gdf.geometry.values, gdf.crs, drop=True, invert=False)
+    da = rioxarray.open_rasterio(dapath, masked=masked, chunks=chunks)
+    clipped = clip_da(da, gdfpath, all_touched=all_touched)
     
     return clipped
+
+
+def clip_raster_many(dapath, gdfpath, id_col, outdir=None, masked=False, chunks=None, all_touched=False):
+    """
+    Clips a raster by each polygon of a geodataframe into separate outputs
+    The raster and vector data are opened once and polygons are visited in
+    raster row order so the windows are read in one pass down the file
+    
+    Args:
+        dapath: Path to raster or a rioxarray Data Array
+        gdfpath: Path to vector polygon dataset or a geodataframe
+        id_col: column with a unique id for each polygon
+        outdir: optional directory to write a geotiff per polygon named by id
+        masked: whether to mask by nodata
+        chunks: optional dask chunks to open the raster with
+        all_touched: include all pixels touched by the polygons
+    
+    Returns:
+        a dictionary keyed by id of clipped rioxarrays, or of geotiff paths when outdir is given,
+        polygons outside the raster are skipped
+        
+    Examples: 
+        clips = clip_raster_many('dapath', 'tenements.shp', 'TENID', outdir='clips')
+    
+    """
+
+    if isinstance(dapath, xr.DataArray):
+        da = dapath
+    else:
+        da = rioxarray.open_rasterio(dapath, masked=masked, chunks=chunks)
+
+    gdf = _read_polygons(gdfpath)
+    if da.rio.crs is not None and gdf.crs is not None and gdf.crs != da.rio.crs:
+        gdf = gdf.to_crs(da.rio.crs)
+
+    # top of each polygon, visited north to south to follow the raster rows
+    order = np.argsort(-gdf.geometry.bounds['maxy'].to_numpy(), kind='stable')
+
+    if outdir is not None:
+        os.makedirs(outdir, exist_ok=True)
+
+    clip_dict = {}
+    skipped = 0
+    for i in order:
+        row = gdf.iloc[[i]]
+        key = row[id_col].iloc[0]
+        try:
+            clipped = _clip_window(da, row, all_touched=all_touched)
+        except NoDataInBounds:
+            skipped += 1
+            continue
+        if outdir is not None:
+            path = os.path.join(outdir, str(key) + '.tif')
+            clipped.rio.to_raster(path)
+            clip_dict[key] = path
+        else:
+            clip_dict[key] = clipped
+
+    if skipped:
+        print(f"skipped {skipped} polygons outside the raster")
+
+    return clip_dict
+    
+
+def _clip_block_worker(dapath, window, items, nodata, outdir, all_touched, compress):
+    """
+    Reads one block window of a raster and writes a clipped geotiff for each polygon in it
+
+    Args:
+        dapath: Path to raster
+        window: rasterio Window covering every polygon in the block
+        items: list of (id, geometry, window relative to the block)
+        nodata: value for pixels outside the polygons
+        outdir: directory to write to
+        all_touched: include all pixels touched by the polygons
+        compress: geotiff compression
+
+    Returns:
+        list of (id, path, width, height)
+    """
+    written = []
+    with rasterio.open(dapath) as src:
+        data = src.read(window=window)
+        block_transform = src.window_transform(window)
+        profile = src.profile.copy()
+
+    for key in ['blockxsize', 'blockysize', 'tiled', 'interleave']:
+        profile.pop(key, None)
+
+    for key, geom, sub in items:
+        transform = rasterio.windows.transform(sub, block_transform)
+        outside = rasterio.features.geometry_mask([geom], out_shape=(sub.height, sub.width), transform=transform, all_touched=all_touched)
+
+        # trim to the rows and columns with pixels inside, as rio.clip(drop=True) does
+        rows = np.flatnonzero(~outside.all(axis=1))
+        cols = np.flatnonzero(~outside.all(axis=0))
+        if rows.size:
+            outside = outside[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+            sub = rasterio.windows.Window(sub.col_off + cols[0], sub.row_off + rows[0], outside.shape[1], outside.shape[0])
+            transform = rasterio.windows.transform(sub, block_transform)
+
+        arr = data[:, sub.row_off:sub.row_off + sub.height, sub.col_off:sub.col_off + sub.width].copy()
+        arr[:, outside] = nodata
+
+        path = os.path.join(outdir, str(key) + '.tif')
+        profile.update(driver='GTiff', width=sub.width, height=sub.height, transform=transform, nodata=nodata, compress=compress)
+        with rasterio.open(path, 'w', **profile) as dst:
+            dst.write(arr)
+
+        written.append((key, path, sub.width, sub.height))
+
+    return written
+
+
+def clip_batch(dapath, gdf, id_col, outdir, block_size=None, processes=None, nodata=None, all_touched=False, compress='DEFLATE'):
+    """
+    Clips one raster by many polygons, writing a geotiff per polygon
+    Polygons are grouped by the raster block their window starts in, each block
+    is read once and the groups are clipped in parallel with a process pool
+    
+    Args:
+        dapath: Path to raster
+        gdf: geodataframe of polygons or a path to one
+        id_col: column with a unique id for each polygon, used for file names
+        outdir: directory to write the clipped geotiffs to
+        block_size: pixel size of the grouping blocks, default is the raster block size scaled up to at least 1024
+        processes: number of worker processes, 1 runs in this process
+        nodata: value outside the polygons, default is the raster nodata
+        all_touched: include all pixels touched by the polygons
+        compress: geotiff compression
+    
+    Returns:
+        dataframe of id, path, width and height of each output
+        
+    Examples: 
+        dfclips = clip_batch('national_magnetics.tif', gdf_tenements, 'TENID', 'clips', processes=8)
+    
+    """
+
+    start = time.perf_counter()
+    gdf = _read_polygons(gdf)
+    os.makedirs(outdir, exist_ok=True)
+
+    with rasterio.open(dapath) as src:
+        if src.crs is not None and gdf.crs is not None and gdf.crs != src.crs:
+            gdf = gdf.to_crs(src.crs)
+        transform = src.transform
+        shape = (src.height, src.width)
+        native_height, native_width = src.block_shapes[0]
+        if nodata is None:
+            nodata = src.nodata
+        if nodata is None:
+            nodata = np.nan if np.issubdtype(np.dtype(src.dtypes[0]), np.floating) else 0
+
+    if block_size is None:
+        block_height = native_height * max(1, math.ceil(1024 / native_height))
+        block_width = native_width * max(1, math.ceil(1024 / native_width))
+    else:
+        block_height = block_width = block_size
+
+    groups = {}
+    skipped = 0
+    bounds = gdf.geometry.bounds.to_numpy()
+    for key, geom, bb in zip(gdf[id_col], gdf.geometry.values, bounds):
+        try:
+            window = _pixel_window(transform, shape, bb)
+        except NoDataInBounds:
+            skipped += 1
+            continue
+        block = (window.row_off // block_height, window.col_off // block_width)
+        groups.setdefault(block, []).append((key, geom, window))
+
+    jobs = []
+    for block, members in sorted(groups.items()):
+        window = rasterio.windows.union(*[w for key, geom, w in members])
+        items = [(key, geom, rasterio.windows.Window(w.col_off - window.col_off, w.row_off - window.row_off, w.width, w.height)) for key, geom, w in members]
+        jobs.append((dapath, window, items, nodata, outdir, all_touched, compress))
+
+    written = []
+    if processes == 1:
+        for job in jobs:
+            written.extend(_clip_block_worker(*job))
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(_clip_block_worker, *job) for job in jobs]
+            for future in as_completed(futures):
+                written.extend(future.result())
+
+    elapsed = time.perf_counter() - start
+    print(f"clipped {len(written)} polygons from {len(jobs)} blocks in {elapsed:.1f}s ({len(written) / max(elapsed, 1e-9):.1f} polygons/s)")
+    if skipped:
+        print(f"skipped {skipped} polygons outside the raster")
+
+    dfclips = pd.DataFrame(written, columns=[id_col, 'path', 'width', 'height'])
+
+    return dfclips
     
 
 def clip_dabox(dapath, bb):
@@ -1440,100 +2940,541 @@ def extract_band(tifpath, findstr):
             return da[idx]
             
             
-def rasterize_one(tilow, strpath, da):
+def _iter_windows(height, width, block_size):
+    """
+    Yields rasterio Windows of at most block_size pixels square covering a raster, row by row
+    """
+    for row in range(0, height, block_size):
+        for col in range(0, width, block_size):
+            yield rasterio.windows.Window(col, row, min(block_size, width - col), min(block_size, height - row))
+
+
+def _geometries_like(gdf, da):
+    """
+    Geometries of a geodataframe in the crs of a DataArray, leaving the frame untouched
+    """
+    geoms = gdf.geometry
+    if da.rio.crs is not None and geoms.crs is not None and geoms.crs != da.rio.crs:
+        geoms = geoms.to_crs(da.rio.crs)
+
+    return geoms
+
+
+def rasterize_one(tilow, strpath, da, all_touched=True, block_size=4096, compress='PACKBITS', nbits=None):
+    """
+    Rasterize a geodataframe to a default one raster
+    Burns straight into uint8 windows of the output grid and writes each to a tiled,
+    compressed geotiff as it goes, so the full grid is never held in memory
+    
+    Args:
+        tilow: gdf, not modified
+        strpath: output geotif path
+        da: raster for resolution and bounds to match
+        all_touched: burn all pixels touched by the geometries
+        block_size: pixel size of the windows rasterized at a time
+        compress: geotiff compression
+        nbits: write a bit-packed geotiff e.g. nbits=1, there is then no nodata value
+    
+    Returns:
+        geotiff to file, the path is returned
+        
+    Examples: 
+        rasterize_one(gdf, outpath, darock)
+        rasterize_one(gdf, outpath, darock, nbits=1)
+    
+    """
+
+    geoms = _geometries_like(tilow, da)
+    transform = da.rio.transform()
+    height, width = da.rio.shape
+
+    profile = dict(
+        driver='GTiff', height=height, width=width, count=1, dtype='uint8', crs=da.rio.crs, transform=transform,
+        nodata=255, compress=compress, tiled=True, blockxsize=256, blockysize=256,
+    )
+    if nbits is not None:
+        profile.update(nbits=nbits, nodata=None)
+
+    with rasterio.open(strpath, 'w', **profile) as dst:
+        for window in _iter_windows(height, width, block_size):
+            rows = geoms.sindex.query(box(*rasterio.windows.bounds(window, transform)), predicate='intersects')
+            burned = np.zeros((window.height, window.width), dtype='uint8')
+            if rows.size:
+                rasterio.features.rasterize(
+                    geoms.values[np.sort(rows)],
+                    out=burned,
+                    transform=rasterio.windows.transform(window, transform),
+                    default_value=1,
+                    all_touched=all_touched,
+                )
+            dst.write(burned, 1, window=window)
+
+    return strpath
+    
+def _feature_ids(geoms, da, all_touched=True):
+    """
+    Rasterizes the row position plus one of each geometry onto the grid of a DataArray
+    Pixels with no geometry are 0, later geometries overwrite earlier ones where they overlap
+
+    Args:
+        geoms: GeoSeries in the crs of da
+        da: raster for resolution and bounds to match
+        all_touched: burn all pixels touched by the geometries
+
+    Returns:
+        uint32 numpy array of feature ids
+    """
+    valid = np.flatnonzero(~(geoms.isna().to_numpy() | geoms.is_empty.to_numpy()))
+    ids = np.zeros(da.rio.shape, dtype='uint32')
+    if valid.size:
+        rasterio.features.rasterize(
+            zip(geoms.values[valid], (valid + 1).tolist()),
+            out=ids,
+            transform=da.rio.transform(),
+            all_touched=all_touched,
+        )
+
+    return ids
+
+
+def rasterize_many(gdf, da, columns=None, categorical=None, strpath=None, all_touched=True, compress='DEFLATE'):
+    """
+    Rasterize many columns and/or the classes of a categorical column of a geodataframe
+    The geometries are rasterized once to feature ids and every value band is a lookup of those ids,
+    so where features overlap a value band takes the value of the last one. Class bands are burned
+    from the features of each class, so a pixel covered by features of several classes is present in each
+    
+    Args:
+        gdf: geodataframe
+        da: raster for resolution and bounds to match
+        columns: list of numeric columns to burn, one band each
+        categorical: column with classes to make a presence band for each
+        strpath: optional output geotiff path
+        all_touched: burn all pixels touched by the geometries
+        compress: geotiff compression
+    
+    Returns:
+        DataArray with a band per column then per class, float32 with nan outside features
+        or uint8 if only categorical is given
+        
+    Examples: 
+        dalith = rasterize_many(gdf_geology, darock, categorical='LITHOLOGY', strpath='lithology.tif')
+        dachem = rasterize_many(gdf_geochem, darock, columns=['Au_ppb', 'Cu_ppm'])
+    
+    """
+
+    if columns is None and categorical is None:
+        raise ValueError("Give columns and/or a categorical column to rasterize")
+
+    geoms = _geometries_like(gdf, da)
+    dtype = 'uint8' if columns is None else 'float32'
+
+    bands = []
+    names = []
+    if columns:
+        ids = _feature_ids(geoms, da, all_touched=all_touched)
+    for column in columns or []:
+        lookup = np.empty(len(gdf) + 1, dtype='float32')
+        lookup[0] = np.nan
+        lookup[1:] = gdf[column].to_numpy(dtype='float32', na_value=np.nan)
+        bands.append(lookup[ids])
+        names.append(str(column))
+
+    if categorical is not None:
+        codes, classes = pd.factorize(gdf[categorical], sort=True)
+        codes[geoms.isna().to_numpy() | geoms.is_empty.to_numpy()] = -1
+        for code, name in enumerate(classes):
+            present = np.zeros(da.rio.shape, dtype=dtype)
+            rows = np.flatnonzero(codes == code)
+            if rows.size:
+                rasterio.features.rasterize(geoms.values[rows], out=present, transform=da.rio.transform(), default_value=1, all_touched=all_touched)
+            bands.append(present)
+            names.append(str(name))
+
+    out = xr.DataArray(
+        np.stack(bands),
+        dims=('band', 'y', 'x'),
+        coords={'band': names, 'y': da.y.values, 'x': da.x.values},
+        attrs={'long_name': tuple(names)},
+    )
+    out = out.rio.write_crs(da.rio.crs).rio.write_transform(da.rio.transform())
+
+    if strpath is not None:
+        out.rio.to_raster(strpath, compress=compress)
+
+    return out
+    
+
+def _distance_block(block, geoms, x, y, transform, max_distance, distance_metric, all_touched, block_info=None):
+    """
+    Distance to the nearest feature for one block of a grid
+    Only features within max_distance of the block are rasterized, in a window padded by
+    max_distance, and blocks with no feature that close are returned as nan without any work
     """
-    Rasterize a geodataframe to a default one raster
+    (r0, r1), (c0, c1) = block_info[None]['array-location']
+    out = np.full((r1 - r0, c1 - c0), np.nan, dtype='float32')
+
+    if distance_metric == 'GREAT_CIRCLE':
+        # metres to degrees, using the shortest degree of latitude and the widest latitude in the block
+        buffer_y = max_distance / 110574.0
+        lat = min(np.abs(y[r0:r1]).max() + buffer_y, 89.9)
+        buffer_x = buffer_y / math.cos(math.radians(lat))
+    else:
+        buffer_x = buffer_y = max_distance
+
+    pad_c = int(math.ceil(buffer_x / abs(transform.a)))
+    pad_r = int(math.ceil(buffer_y / abs(transform.e)))
+    R0, R1 = max(r0 - pad_r, 0), min(r1 + pad_r, len(y))
+    C0, C1 = max(c0 - pad_c, 0), min(c1 + pad_c, len(x))
+    window = rasterio.windows.Window(C0, R0, C1 - C0, R1 - R0)
+
+    rows = geoms.sindex.query(box(*rasterio.windows.bounds(window, transform)), predicate='intersects')
+    if rows.size == 0:
+        return out
+
+    burned = rasterio.features.rasterize(
+        geoms.values[np.sort(rows)],
+        out_shape=(R1 - R0, C1 - C0),
+        transform=rasterio.windows.transform(window, transform),
+        default_value=1,
+        all_touched=all_touched,
+        dtype='uint8',
+    )
+    if not burned.any():
+        return out
+
+    raster = xr.DataArray(burned, dims=('y', 'x'), coords={'y': y[R0:R1], 'x': x[C0:C1]})
+    dist = proximity(raster, target_values=[1], max_distance=max_distance, distance_metric=distance_metric)
+    out[:] = dist.values[r0 - R0:r1 - R0, c0 - C0:c1 - C0]
+
+    return out
+
+
+def feature_distance(gdf, da, class_col=None, distance_metric='EUCLIDEAN', max_distance=np.inf, block_size=1024, all_touched=True):
+    """
+    Distance to the nearest vector feature on the grid of a DataArray, per feature class
+    With a finite max_distance the result is a lazy dask array computed block by block,
+    where blocks with no feature within max_distance are skipped and left as nan
     
     Args:
-        tilow: gdf
-        strpath: output geotif path
+        gdf: geodataframe of features e.g. faults or intrusions
         da: raster for resolution and bounds to match
+        class_col: optional column to compute a separate distance grid per class
+        distance_metric: EUCLIDEAN, GREAT_CIRCLE or MANHATTAN as for xrspatial.proximity
+                         GREAT_CIRCLE needs longitude/latitude coordinates and max_distance in metres
+        max_distance: distances beyond this are nan
+        block_size: pixel size of the dask blocks when max_distance is finite
+        all_touched: burn all pixels touched by the features
     
     Returns:
-        geotiff to file
+        DataArray of distances with a class dimension if class_col is given
         
     Examples: 
-        rasterize_one(gdf, outpath, darock)
+        dadist = feature_distance(gdf_faults, darock, max_distance=20000)
+        dadist = feature_distance(gdf_intrusions, darock, class_col='AGE', max_distance=50000).compute()
     
     """
+    lazy = np.isfinite(max_distance)
+    if lazy:
+        import dask.array as dsa
+
+    geoms = _geometries_like(gdf, da)
+    transform = da.rio.transform()
+    height, width = da.rio.shape
+    x = da.x.values
+    y = da.y.values
+
+    if class_col is None:
+        groups = [(None, geoms)]
+    else:
+        groups = [(name, geoms[(gdf[class_col] == name).to_numpy()]) for name in sorted(gdf[class_col].dropna().unique())]
+        if not groups:
+            raise ValueError(f"class_col {class_col!r} has no non-null classes to measure distance to")
+
+    grids = []
+    for name, class_geoms in groups:
+        if lazy:
+            template = dsa.empty((height, width), chunks=block_size, dtype='float32')
+            grid = template.map_blocks(
+                _distance_block,
+                geoms=class_geoms.reset_index(drop=True),
+                x=x,
+                y=y,
+                transform=transform,
+                max_distance=max_distance,
+                distance_metric=distance_metric,
+                all_touched=all_touched,
+                dtype='float32',
+            )
+        else:
+            burned = np.zeros((height, width), dtype='uint8')
+            if len(class_geoms):
+                rasterio.features.rasterize(class_geoms.values, out=burned, transform=transform, default_value=1, all_touched=all_touched)
+            raster = xr.DataArray(burned, dims=('y', 'x'), coords={'y': y, 'x': x})
+            grid = proximity(raster, target_values=[1], distance_metric=distance_metric).data
+        grids.append(grid)
+
+    if class_col is None:
+        dadist = xr.DataArray(grids[0], dims=('y', 'x'), coords={'y': y, 'x': x})
+    else:
+        stack = dsa.stack(grids) if lazy else np.stack(grids)
+        dadist = xr.DataArray(stack, dims=(class_col, 'y', 'x'), coords={class_col: [g[0] for g in groups], 'y': y, 'x': x})
 
-    bb = da.rio.bounds()
-    geom=json.dumps(mapping(box(bb[0], bb[1], bb[2], bb[3])))
-
-    print(tilow.crs)
-    tilow['TIONE'] = 1
-
-    column = "TIONE"
-
-    out_grid = make_geocube(
-        vector_data=tilow,
-        measurements=[column],
-        resolution=da.rio.resolution(),
-        fill = 0,
-        geom = geom,
-        rasterize_function = partial(rasterize_image, all_touched=True)
-    )
-    out_grid[column].rio.write_nodata(255, inplace=True)
-    out_grid[column]=out_grid[column].astype('uint8')
+    dadist = dadist.rio.write_crs(da.rio.crs).rio.write_transform(transform)
 
-    out_grid[column].rio.to_raster(strpath, compress='PACKBITS')
+    return dadist
     
+
 ## TODO
 ## naive grids in 2D and 3D?
 ## generic geophysics derivatives via harmonica
 ## boring github actions things if ever have time
 
-def csv_to_pyvista(csv_file_path):
+def _count_csv_rows(path, block_size=1 << 24):
+    """
+    Number of data rows in a csv from the newlines in binary blocks, less the header
+    """
+    count = 0
+    last = b''
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            count += block.count(b'\n')
+            last = block[-1:]
+
+    if last and last != b'\n':
+        count += 1
+
+    return max(count - 1, 0)
+
+
+def points_to_pyvista(path, xcol='X', ycol='Y', zcol='Z', attributes=None, chunksize=1_000_000, dtype='float64', voxel_size=None, outpath=None):
+    """
+    Build a PyVista point cloud from a csv or parquet file of points, read in chunks
+    Points and attribute columns are copied chunk by chunk into preallocated arrays that
+    PyVista wraps without copying, so the full dataframe is never held in memory
+
+    Parameters:
+    path (str): csv or parquet file with x, y, z columns
+    xcol, ycol, zcol (str): coordinate columns
+    attributes: list of columns to attach as point data, 'all' for every numeric column
+                integer columns are stored as float64 so missing values can be nan
+    chunksize (int): rows per csv chunk, parquet is read by row group
+    dtype: float32 or float64 for the points
+    voxel_size (float): keep only the first point in each voxel of this size
+    outpath (str): optional .vtp, .vtk, .ply or .vtu file to write
+
+    Returns:
+    pyvista.PolyData: point cloud with attributes as point data
+
+    Examples:
+    cloud = points_to_pyvista('lidar.parquet', attributes=['intensity'], dtype='float32', voxel_size=0.5, outpath='lidar.vtp')
+    """
+    coords = [xcol, ycol, zcol]
+    is_parquet = os.path.splitext(path)[1].lower() in ('.parquet', '.pq')
+
+    if is_parquet:
+        import pyarrow.parquet as pq
+
+        pf = pq.ParquetFile(path)
+        n = pf.metadata.num_rows
+        sample = pf.schema_arrow.empty_table().to_pandas()
+    else:
+        n = _count_csv_rows(path)
+        sample = pd.read_csv(path, nrows=1000)
+
+    if not all(col in sample.columns for col in coords):
+        raise ValueError(f"File must contain {xcol!r}, {ycol!r} and {zcol!r} columns")
+
+    if attributes == 'all':
+        attributes = [c for c in sample.columns if c not in coords and pd.api.types.is_numeric_dtype(sample[c])]
+    attributes = list(attributes or [])
+    missing = [c for c in attributes if c not in sample.columns]
+    if missing:
+        raise ValueError(f"attributes {missing} are not columns of {path}")
+    text = [c for c in attributes if not pd.api.types.is_numeric_dtype(sample[c])]
+    if text:
+        raise ValueError(f"attributes must be numeric columns, {text} are not")
+    columns = coords + attributes
+
+    if is_parquet:
+        chunks = (pf.read_row_group(i, columns=columns).to_pandas() for i in range(pf.num_row_groups))
+    else:
+        chunks = pd.read_csv(path, usecols=columns, chunksize=chunksize)
+
+    points = np.empty((n, 3), dtype=dtype) if voxel_size is None else None
+    point_data = {}
+    kept = []
+    filled = 0
+    for chunk in chunks:
+        xyz = chunk[coords].to_numpy(dtype=dtype)
+        if voxel_size is not None:
+            # first point per voxel within the chunk, repeated across chunks below
+            voxels = np.floor(xyz / voxel_size).astype(np.int64)
+            first = np.sort(np.unique(voxels, axis=0, return_index=True)[1])
+            kept.append((voxels[first], xyz[first], {c: chunk[c].to_numpy()[first] for c in attributes}))
+            continue
+
+        rows = slice(filled, filled + len(chunk))
+        if rows.stop > n:
+            raise ValueError(f"{path} has more rows than the {n} counted")
+        points[rows] = xyz
+        for c in attributes:
+            values = chunk[c].to_numpy()
+            if c not in point_data:
+                attr_dtype = values.dtype if values.dtype.kind == 'f' else np.float64
+                point_data[c] = np.empty(n, dtype=attr_dtype)
+            point_data[c][rows] = values
+        filled = rows.stop
+
+    if voxel_size is None:
+        points = points[:filled]
+        point_data = {c: v[:filled] for c, v in point_data.items()}
+    elif kept:
+        voxels = np.concatenate([k[0] for k in kept])
+        first = np.sort(np.unique(voxels, axis=0, return_index=True)[1])
+        points = np.concatenate([k[1] for k in kept])[first]
+        point_data = {c: np.concatenate([k[2][c] for k in kept])[first] for c in attributes}
+    else:
+        points = np.empty((0, 3), dtype=dtype)
+
+    mesh = pv.PolyData(points)
+    for c, values in point_data.items():
+        mesh.point_data[c] = values
+
+    if outpath is not None:
+        if outpath.lower().endswith('.vtu'):
+            mesh.cast_to_unstructured_grid().save(outpath)
+        else:
+            mesh.save(outpath)
+
+    return mesh
+
+
+def csv_to_pyvista(csv_file_path, attributes=None, **kwargs):
     """
     Import an X,Y,Z CSV file and convert it to a PyVista mesh.
+    The file is read in chunks, see points_to_pyvista for the options.
 
     Parameters:
     csv_file_path (str): Path to the CSV file containing X,Y,Z coordinates.
+    attributes: list of columns to attach as point data, 'all' for every numeric column
 
     Returns:
     pyvista.PolyData: PyVista mesh object created from the CSV data.
     """
-    try:
-        # Read the CSV file
-        df = pd.read_csv(csv_file_path)
 
-        # Ensure the CSV has X, Y, and Z columns
-        required_columns = ['X', 'Y', 'Z']
-        if not all(col in df.columns for col in required_columns):
-            raise ValueError("CSV must contain 'X', 'Y', and 'Z' columns")
+    mesh = points_to_pyvista(csv_file_path, attributes=attributes, **kwargs)
 
-        # Extract X, Y, Z coordinates
-        points = df[required_columns].values
+    return mesh
+
+### 3D
 
-        # Create PyVista mesh from points
-        mesh = pv.PolyData(points)
+def _iter_frames(source, columns):
+    """
+    Yields pandas dataframes of the given columns from a dataframe, a dask dataframe
+    or a parquet path, one partition or row group at a time
+    """
+    
+    if isinstance(source, pd.DataFrame):
+        yield source
+    elif isinstance(source, (str, os.PathLike)):
+        import pyarrow.parquet as pq
+        
+        pf = pq.ParquetFile(source)
+        for i in range(pf.num_row_groups):
+            yield pf.read_row_group(i, columns=columns).to_pandas()
+    else:
+        for i in range(source.npartitions):
+            yield source.get_partition(i)[columns].compute()
 
-        return mesh
 
-    except Exception as e:
-        print(f"An error occurred: {str(e)}")
+def _regular_transform(xs, ys):
+    """
+    Affine transform of cell centre coordinates if they are regularly spaced, otherwise None
+    """
+    
+    if len(xs) < 2 or len(ys) < 2:
         return None
+    dx = xs[1] - xs[0]
+    dy = ys[1] - ys[0]
+    if not (np.allclose(np.diff(xs), dx) and np.allclose(np.diff(ys), dy)):
+        return None
+    
+    return Affine(dx, 0.0, xs[0] - dx / 2, 0.0, dy, ys[0] - dy / 2)
 
-### 3D
 
-def df_to_rioxarray(df, data):
+def df_to_rioxarray(df, data, xcol='x', ycol='y', crs=None):
     """
     Import a dataframe with x,y columns and convert to raster
+    A frame already ordered row by row is reshaped without copying, anything else is
+    scattered onto a north up grid with nan for missing cells
 
     Parameters:
-    df - dataframe
-    data - column in the dataframe to be used as raster data
+    df - dataframe, dask dataframe or path to a parquet file read by row group
+    data - column in the dataframe to be used as raster data, or a list of columns
+    xcol, ycol - coordinate columns
+    crs - optional crs to write so the result is ready for rio methods
 
     Returns:
-    pyvista.PolyData: PyVista mesh object created from the CSV data.
+    DataArray with dims band, y, x, or a Dataset of them when data is a list
     
     Examples:
-    da_grav = df_to_xarray(dfjoin,'gravity')
+    da_grav = df_to_rioxarray(dfjoin,'gravity')
+    ds_survey = df_to_rioxarray('survey.parquet', ['tmi', 'k', 'th', 'u'], crs='EPSG:28350')
     """
 
-    data = np.asarray(df[data]).reshape(1,df.y.unique().size,df.x.unique().size)
-    da = xr.DataArray(data=data,dims=["band","y","x"],coords={"band":[1],"y":df.y.unique(),"x":df.x.unique()})
-    return da
+    columns = [data] if isinstance(data, str) else list(data)
+    arrays = None
+
+    if isinstance(df, pd.DataFrame):
+        x = df[xcol].to_numpy()
+        y = df[ycol].to_numpy()
+        xs = pd.unique(x)
+        ys = pd.unique(y)
+        ny, nx = len(ys), len(xs)
+        if len(df) == nx * ny and (x.reshape(ny, nx) == xs).all() and (y.reshape(ny, nx) == ys[:, None]).all():
+            arrays = {c: df[c].to_numpy().reshape(1, ny, nx) for c in columns}
+        frames = [df]
+    else:
+        # first pass over the pieces for the grid coordinates
+        xs = np.array([])
+        ys = np.array([])
+        for frame in _iter_frames(df, [xcol, ycol]):
+            xs = np.union1d(xs, pd.unique(frame[xcol].to_numpy()))
+            ys = np.union1d(ys, pd.unique(frame[ycol].to_numpy()))
+        frames = _iter_frames(df, [xcol, ycol] + columns)
+
+    if arrays is None:
+        xs = np.sort(xs)
+        ys = np.sort(ys)[::-1]
+        ny, nx = len(ys), len(xs)
+        arrays = {}
+        for frame in frames:
+            ix = np.searchsorted(xs, frame[xcol].to_numpy())
+            iy = ny - 1 - np.searchsorted(ys[::-1], frame[ycol].to_numpy())
+            for c in columns:
+                values = frame[c].to_numpy()
+                if c not in arrays:
+                    dtype = np.result_type(values.dtype, np.float32) if values.dtype.kind in 'iub' else values.dtype
+                    arrays[c] = np.full((1, ny, nx), np.nan, dtype=dtype)
+                arrays[c][0, iy, ix] = values
+
+    coords = {"band": [1], "y": ys, "x": xs}
+    ds = xr.Dataset({c: (["band", "y", "x"], arrays[c]) for c in columns}, coords=coords)
+
+    transform = _regular_transform(xs, ys)
+    if crs is not None:
+        ds = ds.rio.write_crs(crs)
+    if transform is not None:
+        ds = ds.rio.write_transform(transform)
+
+    if isinstance(data, str):
+        return ds[data]
+
+    return ds
     
     
 def df_to_xarray(df, data):
@@ -1549,6 +3490,8 @@ def df_to_xarray(df, data):
     
     Examples:
     da_grav = df_to_xarray(dfjoin,'gravity')
+    
+    Every z, y, x combination must be present, for partial grids see df_to_grid
     """
     
     df = df.sort_values(by=["z","y","x"])
@@ -1558,9 +3501,287 @@ def df_to_xarray(df, data):
     return da
 
     
+def _ascending_xyz(ds):
+    """
+    Dataset or DataArray with x, y and z made ascending by reversed views, not copies
+    """
+    
+    flips = {d: slice(None, None, -1) for d in ('x', 'y', 'z') if ds[d].size > 1 and ds[d].values[0] > ds[d].values[-1]}
+    
+    return ds.isel(flips) if flips else ds
+
+
+def xarray_to_pyvista(ds, variables=None):
+    """
+    Convert a 3D xarray grid to a PyVista ImageData, or a RectilinearGrid if the spacing varies
+    Variables are attached as point data at the cell centre coordinates. A (z, y, x) C ordered
+    array is the Fortran ordered (x, y, z) array VTK wants, so it is wrapped without copying
+    
+    Parameters:
+    ds - xarray Dataset or DataArray with x, y, z dims
+    variables - list of variables to attach, default is every variable with x, y, z dims
+    
+    Returns:
+    pyvista.ImageData or pyvista.RectilinearGrid
+    
+    Examples:
+    grid = xarray_to_pyvista(ds_blockmodel, ['density', 'au'])
+    grid.plot(scalars='au')
+    """
+    
+    if isinstance(ds, xr.DataArray):
+        ds = ds.to_dataset(name=ds.name if ds.name is not None else 'values')
+    if variables is None:
+        variables = [v for v in ds.data_vars if {'x', 'y', 'z'} <= set(ds[v].dims)]
+    
+    ds = _ascending_xyz(ds)
+    axes = [ds[d].values for d in ('x', 'y', 'z')]
+    steps = [a[1] - a[0] if a.size > 1 else 1.0 for a in axes]
+    uniform = all(a.size < 2 or np.allclose(np.diff(a), st) for a, st in zip(axes, steps))
+    
+    if uniform:
+        grid = pv.ImageData(dimensions=[a.size for a in axes], spacing=steps, origin=[a[0] for a in axes])
+    else:
+        grid = pv.RectilinearGrid(*axes)
+    
+    for var in variables:
+        values = np.asarray(ds[var].transpose('x', 'y', 'z').data)
+        grid.point_data[var] = values.ravel(order='F')
+    
+    return grid
+
+
+def xarray_to_pyvista_chunks(ds, outpath, variables=None, chunk_size=64):
+    """
+    Write a 3D xarray grid too large for memory to VTK one z slab at a time
+    Each slab is written as its own .vti or .vtr piece sharing one z layer with the next so
+    there are no gaps, and a .vtm multiblock file that opens all pieces together is written
+    
+    Parameters:
+    ds - xarray Dataset or DataArray with x, y, z dims, dask backed slabs are computed one at a time
+    outpath - path of the .vtm file, pieces go in a directory of the same name
+    variables - list of variables to write, default is every variable with x, y, z dims
+    chunk_size - z layers per slab
+    
+    Returns:
+    list of piece paths
+    
+    Examples:
+    xarray_to_pyvista_chunks(ds_blockmodel.chunk({'z': 32}), 'blockmodel.vtm', chunk_size=32)
+    """
+    
+    if isinstance(ds, xr.DataArray):
+        ds = ds.to_dataset(name=ds.name if ds.name is not None else 'values')
+    ds = _ascending_xyz(ds)
+    
+    stem = os.path.splitext(outpath)[0]
+    os.makedirs(stem, exist_ok=True)
+    nz = ds.z.size
+    
+    pieces = []
+    for i, k0 in enumerate(range(0, max(nz - 1, 1), chunk_size)):
+        slab = ds.isel(z=slice(k0, min(k0 + chunk_size + 1, nz)))
+        grid = xarray_to_pyvista(slab, variables=variables)
+        piece = os.path.join(stem, f"{os.path.basename(stem)}_{i}." + ('vti' if isinstance(grid, pv.ImageData) else 'vtr'))
+        grid.save(piece)
+        pieces.append(piece)
+        print("written:", piece)
+    
+    blocks = "\n".join(
+        f'    <DataSet index="{i}" name="slab_{i}" file="{os.path.relpath(piece, os.path.dirname(os.path.abspath(outpath)))}"/>'
+        for i, piece in enumerate(pieces)
+    )
+    with open(outpath, 'w') as f:
+        f.write(
+            '<?xml version="1.0"?>\n'
+            '<VTKFile type="vtkMultiBlockDataSet" version="1.0" byte_order="LittleEndian">\n'
+            '  <vtkMultiBlockDataSet>\n'
+            f'{blocks}\n'
+            '  </vtkMultiBlockDataSet>\n'
+            '</VTKFile>\n'
+        )
+    
+    return pieces
+
+
+def _axis_positions(values, origin, step, n, tol=1e-6):
+    """
+    Integer cell index of each coordinate along a regular axis, -1 where it is off the axis
+    
+    Parameters:
+    values: coordinates
+    origin, step, n: first coordinate, spacing and number of cells of the axis
+    tol: largest distance from a cell centre as a fraction of step
+    """
+    
+    f = (np.asarray(values, dtype='float64') - origin) / step
+    idx = np.rint(f)
+    on_axis = (np.abs(f - idx) <= tol) & (idx >= 0) & (idx < n)
+    
+    return np.where(on_axis, idx, -1).astype(np.int64)
+
+
+def _coord_positions(values, coords):
+    """
+    Integer index of each value in an arbitrary coordinate list, -1 where it is not in the list
+    """
+    
+    coords = np.asarray(coords, dtype='float64')
+    values = np.asarray(values, dtype='float64')
+    order = np.argsort(coords, kind='stable')
+    sorted_coords = coords[order]
+    
+    if len(coords) > 1:
+        upper = np.clip(np.searchsorted(sorted_coords, values), 1, len(coords) - 1)
+        lower = upper - 1
+        nearest = np.where(np.abs(sorted_coords[lower] - values) <= np.abs(sorted_coords[upper] - values), lower, upper)
+    else:
+        nearest = np.zeros(len(values), dtype=np.int64)
+    match = np.isclose(sorted_coords[nearest], values, rtol=1e-12, atol=1e-12)
+    
+    return np.where(match, order[nearest], -1).astype(np.int64)
+
+
+def _scatter_padded(df, coord_cols, complete, positions):
+    """
+    Scatter the data columns of df into a complete grid dataframe at flat cell positions
+    Cells with no row are null, numeric columns are promoted as a left merge would
+    Where several rows fall in one cell the last one is kept
+    """
+    
+    n = len(next(iter(complete.values())))
+    source = np.full(n, -1, dtype=np.int64)
+    rows = np.flatnonzero(positions >= 0)
+    source[positions[rows]] = rows
+    
+    for col in coord_cols:
+        complete[col] = complete[col].astype(np.result_type(complete[col].dtype, df[col].dtype), copy=False)
+    
+    for col in df.columns:
+        if col not in coord_cols:
+            complete[col] = pd.api.extensions.take(df[col].array, source, allow_fill=True)
+    
+    return pd.DataFrame(complete)
+
+    
+def _infer_axis(values, tol=0.01, step=None):
+    """
+    Grid spacing and first cell centre of a coordinate column
+    Coordinates closer together than the snapping tolerance are merged into one cell, so jitter
+    is never taken for the spacing, and the spacing is fitted through the merged cell centres
+
+    Returns:
+        step, origin
+    """
+    
+    unique = np.unique(values[~np.isnan(values)])
+    gaps = np.diff(unique)
+    gaps = gaps[gaps > 1e-6 * (unique[-1] - unique[0])] if unique.size else gaps
+    if step is None:
+        if gaps.size == 0:
+            return 1.0, float(unique.mean()) if unique.size else 0.0
+        # shrink from the largest gap to the smallest that is still wider than the jitter
+        step = gaps.max()
+        while gaps[gaps > 2 * tol * step].min() < step:
+            step = gaps[gaps > 2 * tol * step].min()
+        fit_step = True
+    else:
+        fit_step = False
+    
+    breaks = np.flatnonzero(np.diff(unique) > 2 * tol * step) + 1
+    centres = np.array([cell.mean() for cell in np.split(unique, breaks)])
+    index = np.rint((centres - centres[0]) / step)
+    if fit_step and centres.size > 1:
+        step, origin = np.polyfit(index, centres, 1)
+    else:
+        origin = np.mean(centres - index * step)
+    
+    return float(step), float(origin)
+
+
+def df_to_grid(df, columns=None, steps=None, origin=None, tol=0.01, sparse=False, chunks=None, xcol='x', ycol='y', zcol='z'):
+    """
+    Build a 3D xarray Dataset from a dataframe of possibly partial, inexact grid points
+    Coordinates are snapped to a regular grid and every value column is scattered into
+    the grid in one pass, missing cells are nan so no padding is needed first
+    
+    Parameters:
+    df - dataframe with x, y, z columns
+    columns - value columns to grid, default is every other column
+    steps - (x_step, y_step, z_step), default is fitted through the coordinates after merging those within tol steps
+    origin - (x0, y0, z0) of the first cell centre, default is fitted through the coordinates the same way
+    tol - largest distance of a point from its cell centre as a fraction of the step
+    sparse - store variables as pydata sparse arrays for mostly empty block models, numeric columns only
+    chunks - optional dask chunks for the Dataset
+    xcol, ycol, zcol - coordinate column names
+    
+    Returns:
+    xarray Dataset with dims z, y, x ascending
+    
+    Examples:
+    ds_bm = df_to_grid(dfblocks, ['density', 'au'], steps=(25, 25, 10))
+    ds_bm = df_to_grid(dfblocks, sparse=True, chunks={'z': 50})
+    """
+    
+    coord_cols = [xcol, ycol, zcol]
+    if columns is None:
+        columns = [c for c in df.columns if c not in coord_cols]
+    if sparse:
+        text = [c for c in columns if not pd.api.types.is_numeric_dtype(df[c])]
+        if text:
+            raise ValueError(f"sparse=True needs numeric columns, empty cells of {text} could not be told from values")
+    values = [df[c].to_numpy(dtype='float64') for c in coord_cols]
+    
+    if steps is None or origin is None:
+        axes = [_infer_axis(v, tol=tol, step=None if steps is None else steps[i]) for i, v in enumerate(values)]
+        steps = [st for st, o in axes] if steps is None else steps
+        origin = [o for st, o in axes] if origin is None else origin
+    shape = [int(np.rint((np.nanmax(v) - o) / st)) + 1 for v, o, st in zip(values, origin, steps)]
+    
+    ix, iy, iz = [_axis_positions(v, o, st, n, tol=tol) for v, o, st, n in zip(values, origin, steps, shape)]
+    off_grid = (ix < 0) | (iy < 0) | (iz < 0)
+    if off_grid.any():
+        raise ValueError(f"{off_grid.sum()} points are further than tol={tol} steps from a cell centre")
+    
+    nx, ny, nz = shape
+    positions = (iz * ny + iy) * nx + ix
+    
+    # keep the last row for any cell given more than once
+    unique_positions, last = np.unique(positions[::-1], return_index=True)
+    rows = len(positions) - 1 - last
+    complete = len(unique_positions) == nx * ny * nz
+    
+    data_vars = {}
+    for col in columns:
+        vals = df[col].to_numpy()[rows]
+        if not complete and vals.dtype.kind in 'iub':
+            vals = vals.astype('float64')
+        fill = np.nan if vals.dtype.kind in 'fc' else (None if vals.dtype.kind == 'O' else 0)
+        
+        if sparse:
+            import sparse as sp
+            
+            cell = np.unravel_index(unique_positions, (nz, ny, nx))
+            arr = sp.COO(np.stack(cell), vals, shape=(nz, ny, nx), fill_value=fill)
+        else:
+            arr = np.full(nx * ny * nz, fill, dtype=vals.dtype)
+            arr[unique_positions] = vals
+            arr = arr.reshape(nz, ny, nx)
+        data_vars[col] = (('z', 'y', 'x'), arr)
+    
+    coords = {dim: o + st * np.arange(n) for dim, o, st, n in zip(['x', 'y', 'z'], origin, steps, shape)}
+    ds = xr.Dataset(data_vars, coords=coords)
+    
+    if chunks is not None:
+        ds = ds.chunk(chunks)
+    
+    return ds
+
+    
 def pad_grid_with_nulls(df, x_min, x_max, y_min, y_max, z_min, z_max, x_step, y_step, z_step):
     """
     Pad a partial grid dataframe with nulls to create a complete 3D grid.
+    Rows are placed by their integer cell index so no tuple grid or float key join is needed.
     
     Parameters:
     df (pd.DataFrame): Input dataframe with columns 'x', 'y', 'z', and any other data columns
@@ -1568,19 +3789,22 @@ def pad_grid_with_nulls(df, x_min, x_max, y_min, y_max, z_min, z_max, x_step, y_
     x_step, y_step, z_step: Step sizes for each dimension
     
     Returns:
-    pd.DataFrame: Padded dataframe with nulls for missing grid points
+    pd.DataFrame: Padded dataframe with nulls for missing grid points, ordered x then y then z
     """
     
-    # Create complete grid
+    # Create complete grid axes
     x = np.arange(x_min, x_max + x_step, x_step)
     y = np.arange(y_min, y_max + y_step, y_step)
     z = np.arange(z_min, z_max + z_step, z_step)
+    nx, ny, nz = len(x), len(y), len(z)
     
-    complete_grid = pd.DataFrame([(xi, yi, zi) for xi in x for yi in y for zi in z],
-                                 columns=['x', 'y', 'z'])
+    ix = _axis_positions(df['x'], x_min, x_step, nx)
+    iy = _axis_positions(df['y'], y_min, y_step, ny)
+    iz = _axis_positions(df['z'], z_min, z_step, nz)
+    positions = np.where((ix >= 0) & (iy >= 0) & (iz >= 0), (ix * ny + iy) * nz + iz, -1)
     
-    # Merge complete grid with existing data
-    merged_df = pd.merge(complete_grid, df, on=['x', 'y', 'z'], how='left')
+    complete = {'x': np.repeat(x, ny * nz), 'y': np.tile(np.repeat(y, nz), nx), 'z': np.tile(z, nx * ny)}
+    merged_df = _scatter_padded(df, ['x', 'y', 'z'], complete, positions)
     
     return merged_df
     
@@ -1588,24 +3812,28 @@ def pad_grid_with_nulls(df, x_min, x_max, y_min, y_max, z_min, z_max, x_step, y_
 def pad_grid_with_nulls2d(df, x_min, x_max, y_min, y_max, x_step, y_step, xcol='x',ycol='y'):
     """
     Pad a partial grid dataframe with nulls to create a complete 2d grid.
+    Rows are placed by their integer cell index so no tuple grid or float key join is needed.
     
     Parameters:
-    df (pd.DataFrame): Input dataframe with columns 'x', 'y', 'z', and any other data columns
-    x_min, x_max, y_min, y_max, z_min, z_max: Bounding box coordinates
-    x_step, y_step, z_step: Step sizes for each dimension
+    df (pd.DataFrame): Input dataframe with columns 'x', 'y', and any other data columns
+    x_min, x_max, y_min, y_max: Bounding box coordinates
+    x_step, y_step: Step sizes for each dimension
     
     Returns:
-    merged_df: Padded dataframe with nulls for missing grid points
+    merged_df: Padded dataframe with nulls for missing grid points, ordered x then y
     """
     
-    # Create complete grid
+    # Create complete grid axes
     x = np.arange(x_min, x_max + x_step, x_step)
     y = np.arange(y_min, y_max + y_step, y_step)
+    nx, ny = len(x), len(y)
     
-    complete_grid = pd.DataFrame([(xi, yi) for xi in x for yi in y], columns=[xcol, ycol])
+    ix = _axis_positions(df[xcol], x_min, x_step, nx)
+    iy = _axis_positions(df[ycol], y_min, y_step, ny)
+    positions = np.where((ix >= 0) & (iy >= 0), ix * ny + iy, -1)
     
-    # Merge complete grid with existing data
-    merged_df = pd.merge(complete_grid, df, on=[xcol, ycol], how='left')
+    complete = {xcol: np.repeat(x, ny), ycol: np.tile(y, nx)}
+    merged_df = _scatter_padded(df, [xcol, ycol], complete, positions)
     
     return merged_df
     
@@ -1613,66 +3841,224 @@ def pad_grid_with_nulls2d(df, x_min, x_max, y_min, y_max, x_step, y_step, xcol='
 def pad_rectilinear_grid_with_nulls(df, x_coords, y_coords, z_coords):
     """
     Pad a partial rectilinear grid dataframe with nulls to create a complete grid.
+    Rows are placed by looking up their index in each coordinate list.
     
     Parameters:
     df (pd.DataFrame): Input dataframe with columns 'x', 'y', 'z', and any other data columns
     x_coords, y_coords, z_coords: Lists of coordinates for each dimension
     
     Returns:
-    merged_df: Padded dataframe with nulls for missing grid points
+    merged_df: Padded dataframe with nulls for missing grid points, ordered x then y then z
     """
     
-    # Create complete grid
-    complete_grid = pd.DataFrame([(x, y, z) for x in x_coords for y in y_coords for z in z_coords],
-                                 columns=['x', 'y', 'z'])
+    x = np.asarray(x_coords)
+    y = np.asarray(y_coords)
+    z = np.asarray(z_coords)
+    nx, ny, nz = len(x), len(y), len(z)
+    
+    ix = _coord_positions(df['x'], x)
+    iy = _coord_positions(df['y'], y)
+    iz = _coord_positions(df['z'], z)
+    positions = np.where((ix >= 0) & (iy >= 0) & (iz >= 0), (ix * ny + iy) * nz + iz, -1)
     
-    # Merge complete grid with existing data
-    merged_df = pd.merge(complete_grid, df, on=['x', 'y', 'z'], how='left')
+    complete = {'x': np.repeat(x, ny * nz), 'y': np.tile(np.repeat(y, nz), nx), 'z': np.tile(z, nx * ny)}
+    merged_df = _scatter_padded(df, ['x', 'y', 'z'], complete, positions)
     
     return merged_df
     
     
-def xarray_to_geoh5(ds, workspace_path, key):
+def _blockmodel_delimiters(ds):
     """
-    Assume x,y,z are dims in lowercase and that you want z in metres and negative
+    Origin and u, v, z cell delimiters of a geoh5 BlockModel for a Dataset with x, y, z dims
+    z is made negative and converted to metres if it looks like kilometres
+    """
+    
+    origin = [ds.rio.bounds()[0],ds.rio.bounds()[1],ds.z.min().values]
+
+    xarr =  np.diff(ds.x)
+    xarr = np.insert(xarr, 0, 0)
+    xarr = np.insert(xarr, -1, 0)
+    u_cell_delimiters =  np.cumsum(xarr)
+
+    yarr =  np.diff(ds.y)
+    yarr = np.insert(yarr, 0, 0)
+    yarr = np.insert(yarr, -1, 0)
+    v_cell_delimiters =  np.cumsum(yarr) * -1
+
+    zarr =  np.diff(ds.z)
+    zarr = np.insert(zarr, 0, 0)
+    zarr = np.insert(zarr, -1, 0)
+    z_cell_delimiters =  np.cumsum(zarr)
+
+    if ds.z.min().values > 0:
+        origin = [ds.rio.bounds()[0],ds.rio.bounds()[1],ds.z.min().values * -1]
+        z_cell_delimiters =  z_cell_delimiters * -1
+
+    if max(abs(ds.z.min().values),abs(ds.z.max().values)) < 1000:
+        z_cell_delimiters =  z_cell_delimiters * 1000
+    
+    return origin, u_cell_delimiters, v_cell_delimiters, z_cell_delimiters
+
+
+def _blockmodel_positions(dims, shape, order=("y", "x", "z")):
+    """
+    Position in the geoh5 cell order of every cell of a 3D variable
+    Equivalent to flipping the first two axes (np.rot90 k=2), transposing to order and
+    flattening, computed once as an index array that can be reused for every variable
     
     Parameters:
-    ds - xarray dataset
-    workspace path - string of location to read/create geoh5 workspace
-    key - name for block model
+    dims - dims of the variable
+    shape - shape of the variable
+    order - dims order of the flattened output
     
-    returns blockmodel for reference - not really useful
+    Returns:
+    integer array of shape with the output position of each cell
     """
     
-    with Workspace(workspace_path) as workspace:
-        print("using:",workspace.geoh5)
+    sizes = dict(zip(dims, shape))
+    strides = {d: int(np.prod([sizes[o] for o in order[k + 1:]])) for k, d in enumerate(order)}
+    dtype = np.int32 if np.prod(shape) < 2**31 else np.int64
+    
+    axes = []
+    for axis, (d, n) in enumerate(zip(dims, shape)):
+        i = np.arange(n, dtype=dtype)
+        if axis < 2:
+            i = n - 1 - i
+        axes.append(i * strides[d])
+    
+    positions = np.zeros(shape, dtype=dtype)
+    for i in np.ix_(*axes):
+        positions += i
+    
+    return positions
+
+
+def _blockmodel_values(da, positions):
+    """
+    Values of a variable in geoh5 cell order without modifying it
+    Dask backed variables are computed and placed block by block
+    """
+    
+    values = np.empty(da.size, dtype=da.dtype)
+    data = da.data
+    
+    if hasattr(data, "__dask_graph__"):
+        offsets = [np.cumsum((0,) + c) for c in data.chunks]
+        for block_index in np.ndindex(*data.numblocks):
+            slices = tuple(slice(o[b], o[b + 1]) for o, b in zip(offsets, block_index))
+            values[positions[slices].ravel()] = np.asarray(data.blocks[block_index].compute()).ravel()
+    else:
+        values[positions.ravel()] = np.asarray(data).ravel()
+    
+    return values
 
-        if 'z' in ds.dims:
-            origin = [ds.rio.bounds()[0],ds.rio.bounds()[1],ds.z.min().values]
 
-            xarr =  np.diff(ds.x)
-            xarr = np.insert(xarr, 0, 0)
-            xarr = np.insert(xarr, -1, 0)
-            u_cell_delimiters =  np.cumsum(xarr)
+def _add_blockmodel_data(blockmodel, ds, key):
+    """
+    Adds every 3D variable of a Dataset to a geoh5 BlockModel, reporting export throughput
+    """
+    
+    positions = {}
+    total = 0
+    start = time.perf_counter()
+    for var in ds.data_vars:
+        if var == 'spatial_ref' or ds[var].ndim != 3:
+            continue
+        
+        var_start = time.perf_counter()
+        da = ds[var]
+        if da.dims not in positions:
+            positions[da.dims] = _blockmodel_positions(da.dims, da.shape)
+        data = _blockmodel_values(da, positions[da.dims])
+        blockmodel.add_data({
+            var : {"association":"CELL","values": data}
+        })
+        
+        elapsed = time.perf_counter() - var_start
+        total += data.nbytes
+        print(f"{key} {var}: {data.size} cells in {elapsed:.2f}s ({data.nbytes / 1e6 / max(elapsed, 1e-9):.1f} MB/s)")
+    
+    elapsed = time.perf_counter() - start
+    print(f"{key}: {total / 1e6:.1f} MB in {elapsed:.2f}s ({total / 1e6 / max(elapsed, 1e-9):.1f} MB/s)")
+
+
+def _grid2d_values(da):
+    """
+    Values of a (y, x) variable in geoh5 Grid2D cell order, rows south to north with x fastest
+    """
+    
+    da = da.transpose('y', 'x')
+    values = da.values
+    if da.y.size > 1 and da.y.values[0] > da.y.values[-1]:
+        values = values[::-1]
+    if da.x.size > 1 and da.x.values[0] > da.x.values[-1]:
+        values = values[:, ::-1]
+    
+    return np.ascontiguousarray(values).ravel()
+
+
+def _add_grid2d_data(grid, ds, key):
+    """
+    Adds every 2D variable of a Dataset to a geoh5 Grid2D
+    A variable with one extra dimension, e.g. band, is added as one data per band
+    """
+    
+    for var in ds.data_vars:
+        if var == 'spatial_ref' or 'x' not in ds[var].dims or 'y' not in ds[var].dims:
+            continue
+        
+        da = ds[var]
+        extra = [d for d in da.dims if d not in ('x', 'y')]
+        if not extra:
+            layers = [(var, da)]
+        elif len(extra) == 1 and da[extra[0]].size == 1:
+            layers = [(var, da.squeeze(extra[0], drop=True))]
+        elif len(extra) == 1:
+            layers = [(f"{var}_{value}", da.sel({extra[0]: value})) for value in da[extra[0]].values]
+        else:
+            print(key, var, "skipped, more than one non spatial dimension", extra)
+            continue
+        
+        for name, layer in layers:
+            print(key, name)
+            grid.add_data({
+                name : {"association":"CELL","values": _grid2d_values(layer)}
+            })
 
-            yarr =  np.diff(ds.y)
-            yarr = np.insert(yarr, 0, 0)
-            yarr = np.insert(yarr, -1, 0)
-            v_cell_delimiters =  np.cumsum(yarr) * -1
 
-            zarr =  np.diff(ds.z)
-            zarr = np.insert(zarr, 0, 0)
-            zarr = np.insert(zarr, -1, 0)
-            z_cell_delimiters =  np.cumsum(zarr)
+def _grid_signature(ds):
+    """
+    Hashable description of the grid of a Dataset so variables on one grid share a geoh5 object
+    """
+    
+    return tuple((d, ds[d].size, float(ds[d].values[0]), float(ds[d].values[-1])) for d in ('x', 'y', 'z') if d in ds.dims)
 
-            if ds.z.min().values > 0 and 1 == 1:
-                origin = [ds.rio.bounds()[0],ds.rio.bounds()[1],ds.z.min().values * -1]
-                z_cell_delimiters =  z_cell_delimiters * -1
 
-            if max(abs(ds.z.min().values),abs(ds.z.max().values)) < 1000:
-                z_cell_delimiters =  z_cell_delimiters * 1000
+def _export_geoh5(workspace, ds, key, objects):
+    """
+    Adds a Dataset or DataArray to an open geoh5 workspace as a BlockModel when it has a z dim
+    and a Grid2D otherwise, reusing an object from objects when one exists on the same grid
+    
+    Parameters:
+    workspace - open geoh5 Workspace
+    ds - xarray Dataset or DataArray, a DataArray is named by key
+    key - name for a new object
+    objects - dictionary of grid signature to geoh5 object, updated in place
+    
+    returns the geoh5 object the data was added to
+    """
+    
+    if isinstance(ds, xr.DataArray):
+        ds = ds.to_dataset(name=key)
+    
+    signature = _grid_signature(ds)
+    entity = objects.get(signature)
+    
+    if 'z' in ds.dims:
+        if entity is None:
+            origin, u_cell_delimiters, v_cell_delimiters, z_cell_delimiters = _blockmodel_delimiters(ds)
 
-            blockmodel = BlockModel.create(
+            entity = BlockModel.create(
                 workspace,
                 origin=origin,
                 u_cell_delimiters=u_cell_delimiters,  # Offsets along u
@@ -1681,25 +4067,81 @@ def xarray_to_geoh5(ds, workspace_path, key):
                 rotation=0.0,
                 name=key,
             )
+            print("BLOCKMODEL INFO",entity.n_cells)
+
+        _add_blockmodel_data(entity, ds, key)
 
-            for var in ds.data_vars:
-                print(key, var)
-                if var != 'spatial_ref':
+    else: #2d
+        if entity is None:
+            bounds = ds.rio.bounds()
+            xres, yres = ds.rio.resolution()
 
-                    ds[var].values = np.rot90(ds[var].values, k=2, axes=(0, 1))
-                    data = ds[var].transpose("y","x","z").values.flatten()
+            entity = Grid2D.create(
+                workspace,
+                origin=[bounds[0], bounds[1], 0.0],
+                u_cell_size=abs(xres),
+                v_cell_size=abs(yres),
+                u_count=ds.x.size,
+                v_count=ds.y.size,
+                rotation=0.0,
+                name=key,
+            )
+            print("GRID2D INFO",entity.n_cells)
 
-                    print(data.shape, ds[var].shape)
+        _add_grid2d_data(entity, ds, key)
+    
+    objects[signature] = entity
+    
+    return entity
 
-                    print("BLOCKMODEL INFO",blockmodel.n_cells)
-                    blockmodel.add_data({
-                        var : {"association":"CELL","values": data}
-                    })
 
-        else: #2d
-            print("NO z dimension")
-            pass
+def xarray_to_geoh5(ds, workspace_path, key):
+    """
+    Assume x,y,z are dims in lowercase and that you want z in metres and negative
+    Data with a z dimension goes to a BlockModel, 2D data to a Grid2D
+    The input Dataset is not modified and dask backed variables are exported chunk by chunk
+    
+    Parameters:
+    ds - xarray dataset or data array
+    workspace path - string of location to read/create geoh5 workspace
+    key - name for block model or grid
+    
+    returns blockmodel or grid for reference - not really useful
+    """
+    
+    with Workspace(workspace_path) as workspace:
+        print("using:",workspace.geoh5)
+        entity = _export_geoh5(workspace, ds, key, {})
         
-        return blockmodel    
+        return entity
+
+
+def xarray_to_geoh5_batch(data_dict, workspace_path):
+    """
+    Write many Datasets and DataArrays to one geoh5 workspace in a single session
+    Items on the same grid are added to one shared BlockModel or Grid2D instead of a copy each
+    
+    Parameters:
+    data_dict - dictionary of name to xarray dataset or data array e.g. from tif_dict
+    workspace path - string of location to read/create geoh5 workspace
+    
+    returns dictionary of name to the geoh5 object its data was added to
+    
+    Examples:
+    xarray_to_geoh5_batch(tif_dict(r'D:\\BananaSplits'), 'project.geoh5')
+    """
+    
+    start = time.perf_counter()
+    objects = {}
+    entities = {}
+    with Workspace(workspace_path) as workspace:
+        print("using:",workspace.geoh5)
+        for key, ds in data_dict.items():
+            entities[key] = _export_geoh5(workspace, ds, key, objects)
+    
+    elapsed = time.perf_counter() - start
+    print(f"exported {len(data_dict)} items to {len(objects)} objects in {elapsed:.1f}s")
+    
+    return entities
     
     
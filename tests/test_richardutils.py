@@ -1,4 +1,36 @@
+import os
+import pytest
+import numpy as np
+import pandas as pd
+import rasterio
+import rasterio.features
+import xarray as xr
+import geopandas as gpd
+import shapely
+from shapely.geometry import Polygon, box
+import pyvista as pv
+from geoh5py.workspace import Workspace
+
 from richardutils import richardfunction
+from richardutils import clip_da, clip_raster_many, clip_batch
+from richardutils import df_bb, bb_ids, df_bb_many, gdf_bb, gdf_bb_many
+from richardutils import stream_bb
+from richardutils import rasterize_one, rasterize_many
+from richardutils import feature_distance
+from richardutils import pad_grid_with_nulls, pad_grid_with_nulls2d, pad_rectilinear_grid_with_nulls
+from richardutils import df_to_rioxarray, df_to_xarray, df_to_grid
+from richardutils import xarray_to_geoh5, xarray_to_geoh5_batch
+from richardutils import csv_to_pyvista, points_to_pyvista
+from richardutils import xarray_to_pyvista, xarray_to_pyvista_chunks
+from richardutils import mmnorm, norm_diff_comparison
+from richardutils import plotmap, plotmap_background, plot_limits, plothist, render_batch
+from richardutils import histogram_counts, plothist_combo
+from richardutils import export_tiles
+from richardutils import MapFigure, render_stack
+from richardutils import cetrainbow
+from richardutils import plotgdf, plotgdf_da
+from richardutils.richardutils import _gdf_view
+from richardutils.richardutils import _screen_decimate, _color_limits
 
 
 EPSILON = 1e-9
@@ -8,3 +40,655 @@ def test_richardfunction():
     Test that our roots are square.
     """
     assert abs(richardfunction(1000) - 31.6227766017) < EPSILON
+
+
+def _make_raster(height=40, width=50, res=10.0, crs='EPSG:32750'):
+    """
+    Small north up test raster with unique cell values.
+    """
+    x = 500000 + res / 2 + res * np.arange(width)
+    y = 7000000 - res / 2 - res * np.arange(height)
+    values = np.arange(height * width, dtype='float64').reshape(1, height, width)
+    da = xr.DataArray(values, dims=['band', 'y', 'x'], coords={'band': [1], 'y': y, 'x': x})
+
+    return da.rio.write_crs(crs)
+
+
+def _make_polygons(crs='EPSG:32750'):
+    """
+    Two small polygons inside the test raster.
+    """
+    polys = [
+        Polygon([(500055, 6999945), (500120, 6999930), (500090, 6999880)]),
+        Polygon([(500300, 6999800), (500380, 6999800), (500380, 6999700), (500300, 6999700)]),
+    ]
+
+    return gpd.GeoDataFrame({'TENID': ['a', 'b']}, geometry=polys, crs=crs)
+
+
+def test_clip_da_matches_full_clip(tmp_path):
+    """
+    Test that the windowed clip gives the same pixels as clipping the whole raster.
+    """
+    da = _make_raster()
+    gdf = _make_polygons()
+    expected = da.rio.clip(gdf.geometry.values, gdf.crs, drop=True)
+    clipped = clip_da(da, gdf)
+    assert clipped.shape == expected.shape
+    assert (clipped.x.values == expected.x.values).all()
+    assert clipped.fillna(-1).equals(expected.fillna(-1))
+
+    clips = clip_raster_many(da, gdf, 'TENID')
+    assert set(clips) == {'a', 'b'}
+    assert clips['b'].shape == (1, 10, 8)
+
+    outside = gpd.GeoDataFrame({'TENID': ['far']}, geometry=[Polygon([(0, 0), (10, 0), (10, 10)])], crs=gdf.crs)
+    paths = clip_raster_many(da, pd.concat([gdf, outside]), 'TENID', outdir=str(tmp_path / 'clips'))
+    assert set(paths) == {'a', 'b'}
+    assert rasterio.open(paths['b']).shape == (10, 8)
+
+
+def test_clip_batch_writes_one_file_per_polygon(tmp_path):
+    """
+    Test that the batch clip writes each polygon and masks outside pixels.
+    """
+    da = _make_raster()
+    gdf = _make_polygons()
+    dapath = str(tmp_path / 'raster.tif')
+    da.rio.to_raster(dapath)
+
+    dfclips = clip_batch(dapath, gdf, 'TENID', str(tmp_path / 'clips'), block_size=16, processes=1)
+    assert list(dfclips['TENID']) == ['a', 'b']
+
+    expected = da.rio.clip(gdf.geometry.values[:1], gdf.crs, drop=True)
+    with rasterio.open(dfclips['path'][0]) as src:
+        clipped = src.read()
+    assert clipped.shape == expected.shape
+    assert np.array_equal(np.isnan(clipped), np.isnan(expected.values))
+
+
+def test_df_bb_mask_and_index_agree():
+    """
+    Test that the mask and sorted index filters give the same rows and box ids.
+    """
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({'longitude': rng.uniform(110, 155, 5000), 'latitude': rng.uniform(-45, -10, 5000)})
+    bb = [120, -30, 130, -20]
+    expected = df[(df.longitude > 120) & (df.longitude < 130) & (df.latitude > -30) & (df.latitude < -20)]
+
+    assert df_bb(df, bb).equals(expected)
+    assert df_bb(df, bb, index=True).equals(expected)
+    assert df_bb(df, bb, index=True).equals(expected)
+
+    bbs = [bb, [125, -25, 140, -15]]
+    ids = bb_ids(df, bbs)
+    assert np.array_equal(ids, bb_ids(df, bbs, index=True))
+    assert (ids[expected.index] == 0).all()
+    assert len(df_bb_many(df, bbs)) == (ids >= 0).sum()
+
+    gdf = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.longitude, df.latitude))
+    assert gdf_bb(gdf, bb).index.equals(gdf.cx[120:130, -30:-20].index)
+    assert np.array_equal(gdf_bb_many(gdf, bbs)['bb_id'].to_numpy(), ids[ids >= 0])
+
+
+def test_stream_bb_csv_and_parquet(tmp_path):
+    """
+    Test that streaming csv and parquet filtering keeps the same points as df_bb.
+    """
+    rng = np.random.default_rng(1)
+    df = pd.DataFrame({'longitude': rng.uniform(110, 155, 2000), 'latitude': rng.uniform(-45, -10, 2000), 'au': rng.uniform(0, 1, 2000)})
+    bb = [120, -30, 130, -20]
+    expected = df_bb(df, bb).reset_index(drop=True)
+
+    csvpath = str(tmp_path / 'points.csv')
+    df.to_csv(csvpath, index=False)
+    assert stream_bb(csvpath, str(tmp_path / 'csv.parquet'), bb=bb, chunksize=300) == len(expected)
+    gdf = gpd.read_parquet(tmp_path / 'csv.parquet')
+    assert gdf.crs == 'EPSG:4326'
+    assert np.allclose(gdf['au'], expected['au'])
+
+    df['hole'] = np.where(np.arange(len(df)) < 1000, '1', '0.5')
+    df.to_csv(csvpath, index=False)
+    assert stream_bb(csvpath, str(tmp_path / 'mixed.parquet'), bb=bb, chunksize=300) == len(expected)
+    assert pd.read_parquet(tmp_path / 'mixed.parquet')['hole'].dtype == 'float64'
+
+    # a caller dtype is kept and a text column empty in the first chunks becomes a string column
+    df['id'] = 10**17 + np.arange(len(df))
+    df['hole'] = np.where(np.arange(len(df)) < 1000, None, 'x')
+    df.to_csv(csvpath, index=False)
+    assert stream_bb(csvpath, str(tmp_path / 'typed.parquet'), bb=bb, chunksize=300, dtype={'id': 'int64'}) == len(expected)
+    typed = pd.read_parquet(tmp_path / 'typed.parquet')
+    assert typed['id'].dtype == 'int64'
+    assert typed['id'].tolist() == df_bb(df, bb)['id'].tolist()
+    assert typed['hole'].tolist() == df_bb(df, bb)['hole'].tolist()
+
+    df.iloc[:0].to_csv(csvpath, index=False)
+    assert stream_bb(csvpath, str(tmp_path / 'empty.parquet'), bb=bb) == 0
+    assert len(gpd.read_parquet(tmp_path / 'empty.parquet')) == 0
+    df = df.drop(columns=['hole', 'id'])
+
+    parquetpath = str(tmp_path / 'points.parquet')
+    df.sort_values('longitude').to_parquet(parquetpath, row_group_size=200, index=False)
+    assert stream_bb(parquetpath, str(tmp_path / 'pq.parquet'), bb=bb, geometry=False) == len(expected)
+    assert np.allclose(np.sort(pd.read_parquet(tmp_path / 'pq.parquet')['au']), np.sort(expected['au']))
+
+
+def test_rasterize_one_windowed(tmp_path):
+    """
+    Test that windowed burning matches one rasterize call and leaves the frame alone.
+    """
+    da = _make_raster()
+    gdf = _make_polygons()
+    columns = list(gdf.columns)
+    expected = rasterio.features.rasterize(gdf.geometry.values, out_shape=da.rio.shape, transform=da.rio.transform(), all_touched=True, dtype='uint8')
+
+    path = rasterize_one(gdf, str(tmp_path / 'mask.tif'), da, block_size=16)
+    assert list(gdf.columns) == columns
+    with rasterio.open(path) as src:
+        assert src.dtypes[0] == 'uint8'
+        assert np.array_equal(src.read(1), expected)
+
+
+def test_rasterize_many_bands():
+    """
+    Test that value and class bands come from one set of feature ids.
+    """
+    da = _make_raster()
+    gdf = _make_polygons().assign(grade=[1.5, 2.5], rock=['granite', 'basalt'])
+    mask = rasterio.features.rasterize(gdf.geometry.values[1:], out_shape=da.rio.shape, transform=da.rio.transform(), all_touched=True)
+
+    out = rasterize_many(gdf, da, columns=['grade'], categorical='rock')
+    assert list(out.band.values) == ['grade', 'basalt', 'granite']
+    assert out.dtype == 'float32'
+    assert np.array_equal(out.sel(band='basalt').values, mask)
+    assert (out.sel(band='grade').values[mask == 1] == 2.5).all()
+
+    # a granite polygon over the basalt one, the overlap is in both class bands and takes the last grade
+    overlap = gpd.GeoDataFrame({'grade': [3.5], 'rock': ['granite']}, geometry=[box(500340, 6999650, 500420, 6999750)], crs=gdf.crs)
+    layered = gpd.GeoDataFrame(pd.concat([gdf, overlap], ignore_index=True), crs=gdf.crs)
+    top = rasterio.features.rasterize(overlap.geometry.values, out_shape=da.rio.shape, transform=da.rio.transform(), all_touched=True)
+    both = rasterize_many(layered, da, columns=['grade'], categorical='rock')
+    assert (mask & top).any()
+    assert np.array_equal(both.sel(band='basalt').values, mask)
+    assert (both.sel(band='granite').values[top == 1] == 1).all()
+    assert (both.sel(band='grade').values[top == 1] == 3.5).all()
+
+    classes = rasterize_many(gdf, da, categorical='rock')
+    assert classes.dtype == 'uint8'
+    assert classes.sum() == out.sel(band=['basalt', 'granite']).sum()
+
+
+def test_feature_distance_blocks_match_full_grid():
+    """
+    Test that the blocked distance grid matches proximity over the whole grid.
+    """
+    da = _make_raster()
+    gdf = _make_polygons().assign(rock=['granite', 'basalt'])
+
+    full = feature_distance(gdf, da, class_col='rock')
+    blocked = feature_distance(gdf, da, class_col='rock', max_distance=60, block_size=16)
+    assert blocked.dims == ('rock', 'y', 'x')
+    expected = full.where(full <= 60).values
+    assert np.allclose(blocked.values, expected, equal_nan=True)
+    assert np.isnan(blocked.sel(rock='granite').values[-16:, -16:]).all()
+
+    with pytest.raises(ValueError):
+        feature_distance(gdf.assign(rock=None), da, class_col='rock', max_distance=60)
+
+
+def _partial_block_model():
+    """
+    A block model with a third of its cells missing and mixed column types.
+    """
+    rng = np.random.default_rng(2)
+    x, y, z = np.meshgrid(np.arange(0, 50, 10.0), np.arange(100, 140, 10.0), np.arange(-30, 0, 5.0), indexing='ij')
+    df = pd.DataFrame({'x': x.ravel(), 'y': y.ravel(), 'z': z.ravel()})
+    df['density'] = rng.uniform(2, 3, len(df))
+    df['domain'] = rng.integers(1, 5, len(df))
+    df['rock'] = rng.choice(['ore', 'waste'], len(df))
+
+    return df.sample(frac=0.66, random_state=3)
+
+
+def test_pad_grid_with_nulls_matches_merge():
+    """
+    Test that scattered padding gives the same frame as merging onto a tuple grid.
+    """
+    df = _partial_block_model()
+    x, y, z = np.arange(0, 50, 10.0), np.arange(100, 140, 10.0), np.arange(-30, 0, 5.0)
+    grid = pd.DataFrame([(xi, yi, zi) for xi in x for yi in y for zi in z], columns=['x', 'y', 'z'])
+    expected = pd.merge(grid, df, on=['x', 'y', 'z'], how='left')
+
+    pd.testing.assert_frame_equal(pad_grid_with_nulls(df, 0, 40, 100, 130, -30, -5, 10, 10, 5), expected)
+    pd.testing.assert_frame_equal(pad_rectilinear_grid_with_nulls(df, x, y, z), expected)
+
+    df2 = df[df.z == -5].drop(columns='z')
+    grid2 = pd.DataFrame([(xi, yi) for xi in x for yi in y], columns=['x', 'y'])
+    expected2 = pd.merge(grid2, df2, on=['x', 'y'], how='left')
+    pd.testing.assert_frame_equal(pad_grid_with_nulls2d(df2, 0, 40, 100, 130, 10, 10), expected2)
+
+
+def test_df_to_grid_snaps_and_fills():
+    """
+    Test that jittered partial block models grid to the same values as the complete frame.
+    """
+    rng = np.random.default_rng(4)
+    df = _partial_block_model()
+    jittered = df.assign(x=df.x + rng.uniform(-0.05, 0.05, len(df)))
+
+    ds = df_to_grid(jittered, ['density', 'domain'], steps=(10, 10, 5), origin=(0, 100, -30))
+    assert ds.density.dims == ('z', 'y', 'x')
+    assert ds.density.shape == (6, 4, 5)
+    assert int(ds.density.notnull().sum()) == len(df)
+
+    padded = pad_grid_with_nulls(df, 0, 40, 100, 130, -30, -5, 10, 10, 5)
+    expected = df_to_xarray(padded, 'density')
+    assert np.allclose(ds.density.values, expected.values, equal_nan=True)
+    assert np.allclose(ds.domain.values, df_to_xarray(padded, 'domain').values, equal_nan=True)
+
+    with pytest.raises(ValueError):
+        df_to_grid(jittered, ['density'], steps=(10, 10, 5), tol=0.001)
+
+    inferred = df_to_grid(jittered, ['density'])
+    assert np.allclose(inferred.x, [0, 10, 20, 30, 40], atol=0.05)
+    assert np.allclose(inferred.density.values, expected.values, equal_nan=True)
+
+    with pytest.raises(ValueError):
+        df_to_grid(df, ['rock'], sparse=True)
+
+
+def test_df_to_rioxarray_ordered_shuffled_and_parquet(tmp_path):
+    """
+    Test that ordered, shuffled and row group input give the same georeferenced grid.
+    """
+    da = _make_raster(height=6, width=5)
+    df = da.squeeze('band', drop=True).to_dataframe(name='tmi').reset_index()[['y', 'x', 'tmi']]
+    df['k'] = df['tmi'] * 2
+
+    ordered = df_to_rioxarray(df, 'tmi', crs='EPSG:32750')
+    assert np.array_equal(ordered.values, da.values)
+    assert ordered.rio.transform() == da.rio.transform()
+    assert ordered.rio.crs == da.rio.crs
+
+    shuffled = df.iloc[1:].sample(frac=1, random_state=5)
+    ds = df_to_rioxarray(shuffled, ['tmi', 'k'])
+    missing = df.iloc[0]
+    assert np.isnan(ds.tmi.sel(x=missing.x, y=missing.y)).all()
+    assert np.allclose(ds.k.fillna(0).values.ravel()[1:], 2 * da.values.ravel()[1:])
+
+    path = str(tmp_path / 'grid.parquet')
+    shuffled.to_parquet(path, row_group_size=7, index=False)
+    assert df_to_rioxarray(path, ['tmi', 'k']).equals(ds)
+
+
+def _block_model_dataset():
+    """
+    Small (z, y, x) block model Dataset with two variables.
+    """
+    rng = np.random.default_rng(6)
+    coords = {'z': np.arange(4) * 10.0 + 10, 'y': 7000000 + np.arange(5)[::-1] * 25.0, 'x': 500000 + np.arange(6) * 25.0}
+    ds = xr.Dataset({v: (('z', 'y', 'x'), rng.random((4, 5, 6))) for v in ['density', 'au']}, coords=coords)
+
+    return ds.rio.write_crs('EPSG:28350')
+
+
+def test_xarray_to_geoh5_cell_order(tmp_path):
+    """
+    Test that chunked export matches the rot90 and transpose ordering without changing the input.
+    """
+    ds = _block_model_dataset()
+    before = ds.density.values.copy()
+    legacy = np.rot90(ds.density.values, k=2, axes=(0, 1))
+    legacy = xr.DataArray(legacy, dims=ds.density.dims).transpose('y', 'x', 'z').values.flatten()
+
+    path = str(tmp_path / 'bm.geoh5')
+    xarray_to_geoh5(ds.chunk({'z': 3, 'y': 2}), path, 'bm')
+    assert np.array_equal(ds.density.values, before)
+
+    with Workspace(path) as workspace:
+        blockmodel = workspace.get_entity('bm')[0]
+        assert np.allclose(blockmodel.get_data('density')[0].values, legacy)
+
+
+def test_xarray_to_geoh5_batch_shares_grids(tmp_path):
+    """
+    Test that 2D grids on the same extent share one Grid2D in south to north row order.
+    """
+    da = _make_raster(height=4, width=3)
+    data_dict = {'tmi': da, 'rtp': da * 2, 'bm': _block_model_dataset()}
+
+    path = str(tmp_path / 'project.geoh5')
+    entities = xarray_to_geoh5_batch(data_dict, path)
+    assert entities['tmi'] is entities['rtp']
+    assert entities['bm'] is not entities['tmi']
+
+    with Workspace(path) as workspace:
+        grid = workspace.get_entity('tmi')[0]
+        assert grid.n_cells == 12
+        assert np.allclose(grid.get_data('rtp')[0].values, 2 * da.values[0, ::-1].ravel())
+        assert np.allclose(grid.centroids[0, :2], [da.x.values[0], da.y.values[-1]])
+
+
+def test_points_to_pyvista_chunks_and_voxels(tmp_path):
+    """
+    Test that chunked point reading keeps every point and attribute and voxels decimate.
+    """
+    rng = np.random.default_rng(7)
+    df = pd.DataFrame({'X': rng.uniform(0, 10, 1000), 'Y': rng.uniform(0, 10, 1000), 'Z': rng.uniform(0, 1, 1000)})
+    df['intensity'] = rng.integers(0, 255, 1000)
+    df['label'] = 'ground'
+    path = str(tmp_path / 'points.csv')
+    df.to_csv(path, index=False)
+
+    mesh = csv_to_pyvista(path, attributes='all', chunksize=300)
+    assert mesh.n_points == 1000
+    assert np.allclose(mesh.points, df[['X', 'Y', 'Z']].to_numpy())
+    assert np.array_equal(mesh.point_data['intensity'], df['intensity'])
+    assert 'label' not in mesh.point_data
+    with pytest.raises(ValueError, match='numeric'):
+        points_to_pyvista(path, attributes=['intensity', 'label'])
+
+    decimated = points_to_pyvista(path, voxel_size=5, chunksize=300, dtype='float32', outpath=str(tmp_path / 'points.vtp'))
+    assert decimated.n_points == 4
+    assert decimated.points.dtype == np.float32
+    assert (tmp_path / 'points.vtp').exists()
+
+
+def test_xarray_to_pyvista_zero_copy_and_chunks(tmp_path):
+    """
+    Test that ImageData wraps the block model without copying and slabs reassemble.
+    """
+    ds = _block_model_dataset()
+    north = ds.isel(y=slice(None, None, -1)).copy(deep=True)
+    grid = xarray_to_pyvista(north)
+    assert isinstance(grid, pv.ImageData)
+    assert grid.dimensions == (6, 5, 4)
+    assert np.shares_memory(grid.point_data['density'], north.density.values)
+    assert grid.point_data['density'][6] == ds.density.values[0, -2, 0]
+    assert np.array_equal(xarray_to_pyvista(ds).point_data['au'], grid.point_data['au'])
+
+    uneven = ds.assign_coords(z=[10.0, 20.0, 40.0, 80.0])
+    assert isinstance(xarray_to_pyvista(uneven, ['au']), pv.RectilinearGrid)
+
+    pieces = xarray_to_pyvista_chunks(ds.chunk({'z': 2}), str(tmp_path / 'bm.vtm'), chunk_size=2)
+    assert len(pieces) == 2
+    blocks = pv.read(str(tmp_path / 'bm.vtm'))
+    assert blocks.n_blocks == 2
+    assert blocks[0].dimensions == (6, 5, 3)
+
+
+def test_mmnorm_and_norm_diff_comparison():
+    """
+    Test single pass normalisation, percentile sketches and fused diff and ratio.
+    """
+    da = _make_raster()
+    other = (da * 3 + 1).where(da != 10)
+
+    assert float(mmnorm(da).min()) == 0 and float(mmnorm(da).max()) == 1
+    assert mmnorm(da.chunk(16)).chunks is not None
+    assert np.allclose(mmnorm(da.chunk(16)).values, mmnorm(da).values)
+
+    robust = mmnorm(da, percentiles=(2, 98), bins=2000)
+    exact = (da - np.nanpercentile(da, 2)) / (np.nanpercentile(da, 98) - np.nanpercentile(da, 2))
+    assert np.allclose(robust.values, exact.clip(0, 1).values, atol=0.002)
+
+    diff, ratio = norm_diff_comparison(da, other)
+    assert np.allclose(diff.values, (mmnorm(da) - mmnorm(other)).values, equal_nan=True)
+    lazy_diff, lazy_ratio = norm_diff_comparison(da.chunk(16), other.chunk(16))
+    assert lazy_ratio.chunks is not None
+    assert np.allclose(lazy_ratio.values, ratio.values, equal_nan=True)
+
+
+def test_plotmap_decimates_to_screen(tmp_path):
+    """
+    Test block reduction and overview reads give about one cell per screen pixel.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import rioxarray
+
+    da = _make_raster(height=400, width=500)
+    assert _screen_decimate(da, size=1, dpi=100).shape == (1, 80, 100)
+    assert _screen_decimate(da, size=10, dpi=50) is da
+
+    lazy = _screen_decimate(da.chunk(100), size=1, dpi=100, method='max')
+    assert lazy.chunks is not None
+    assert float(lazy.max()) == float(da.max())
+
+    classes = xr.DataArray(np.array([[1, 1, 2, 7], [1, 3, np.nan, 7]]), dims=('y', 'x'))
+    mode = _screen_decimate(classes, size=1, dpi=2, method='mode')
+    assert mode.values.tolist() == [[1.0, 7.0]]
+    codes = xr.DataArray(np.array([[1, 1, 2, 7], [1, 3, 7, 7]]), dims=('y', 'x'))
+    assert _screen_decimate(codes, size=1, dpi=2).values.tolist() == [[1.5, 5.75]]
+    codes.attrs['flag_values'] = [1, 2, 3, 7]
+    assert _screen_decimate(codes, size=1, dpi=2).values.tolist() == [[1, 7]]
+    mask = xr.DataArray(np.array([[True, True, False, False], [True, False, False, False]]), dims=('y', 'x'))
+    assert _screen_decimate(mask, size=1, dpi=2).values.tolist() == [[True, False]]
+
+    path = tmp_path / 'overviews.tif'
+    da.rio.to_raster(path)
+    with rasterio.open(path, 'r+') as dst:
+        dst.build_overviews([2, 4])
+    opened = rioxarray.open_rasterio(path)
+    decimated = _screen_decimate(opened, size=1.25, dpi=100)
+    assert decimated.shape == (1, 100, 125)
+    assert decimated.rio.resolution() == (40.0, -40.0)
+
+    plotmap(da.squeeze('band'), cmap='viridis', size=1, dpi=100, savefig=False)
+    assert plt.gca().collections[0].get_array().shape == (80, 100)
+    plt.close('all')
+
+
+def test_plot_limits():
+    """
+    Test sampled and sketched colour limits against exact percentiles and the per array cache.
+    """
+    da = _make_raster(height=200, width=300)
+    exact = np.nanpercentile(da, [2, 98])
+
+    assert plot_limits(da) == (None, None)
+    vmin, vmax = plot_limits(da, robust=True)
+    assert np.allclose([vmin, vmax], exact)
+    assert plot_limits(da, clip=95)[0] is None
+
+    sampled = plot_limits(da, robust=True, sample=5000)
+    assert np.allclose(sampled, exact, rtol=0.01)
+    assert plot_limits(da, robust=True, sample=5000) is sampled
+
+    sketched = plot_limits(da.chunk(50), robust=True, bins=1000)
+    assert np.allclose(sketched, exact, atol=float(da.max() - da.min()) / 1000)
+
+    # plotmap_background masks negatives, its limits come from the full resolution input and are cached
+    import matplotlib.pyplot as plt
+    signed = (da - 30000).squeeze('band')
+    expected = np.nanpercentile(signed.values[signed.values >= 0], 90)
+    plotmap_background(signed, cmap='viridis', clip=90, size=1, dpi=100, savefig=False, background=True)
+    assert np.isclose(plt.gca().collections[-1].get_clim()[1], expected)
+    assert plot_limits(signed, clip=90, min_value=0) == (None, plt.gca().collections[-1].get_clim()[1])
+    plt.close('all')
+
+
+def test_render_batch(tmp_path):
+    """
+    Test batch rendering writes every png, keeps spec order and leaves no figures open.
+    """
+    import matplotlib.pyplot as plt
+
+    da = _make_raster().squeeze('band')
+    specs = [
+        dict(func='plotmap', da=da, title='map', cmap='viridis', size=2),
+        dict(func=plothist, da=da, title='hist'),
+        dict(func='plotmapw', da=da, title='mapw', cmap='viridis', clip=90, size=2),
+    ]
+
+    slides, timings = render_batch(specs, outdir=tmp_path, processes=2, slide_dict={'cover': 'cover.png'})
+    assert list(slides) == ['cover', 'map', 'hist', 'mapw']
+    assert all((tmp_path / f'{title}.png').exists() for title in ['map', 'hist', 'mapw'])
+    assert list(timings['title']) == ['map', 'hist', 'mapw'] and (timings['seconds'] > 0).all()
+
+    cwd = os.getcwd()
+    user_figure = plt.figure()
+    serial, _ = render_batch(specs[:2], outdir=tmp_path / 'serial', processes=1)
+    assert serial['map'] == str(tmp_path / 'serial' / 'map.png')
+    assert (tmp_path / 'serial' / 'hist.png').exists()
+    assert os.getcwd() == cwd
+    assert plt.get_fignums() == [user_figure.number] and not user_figure.axes
+    plt.close(user_figure)
+
+
+def test_cetrainbow_cached_and_registered():
+    """
+    Test the CET rainbow is built once, copied out and usable by name in the plot functions.
+    """
+    import matplotlib
+    import matplotlib.pyplot as plt
+
+    cmap = cetrainbow()
+    assert cmap.N == 256
+    assert np.allclose(cmap(0.0), (0, 48 / 255, 245 / 255, 1))
+    assert cmap is not cetrainbow()
+    assert np.allclose(cetrainbow(reverse=True)(0.0), cmap(1.0))
+    assert 'cetrainbow' in matplotlib.colormaps and 'cetrainbow_r' in matplotlib.colormaps
+
+    plotmap(_make_raster().squeeze('band'), size=1, savefig=False)
+    plt.close('all')
+
+
+def test_plotgdf_view_prepass():
+    """
+    Test clipping to the view, pixel simplification and rasterized drawing of a polygon layer.
+    """
+    import matplotlib.pyplot as plt
+
+    angles = np.linspace(0, 2 * np.pi, 2000, endpoint=False)
+    circles = [Polygon(np.column_stack([cx + np.cos(angles), np.sin(angles)])) for cx in range(0, 30, 3)]
+    gdf = gpd.GeoDataFrame({'unit': list('abcdeabcde'), 'value': np.arange(10.0)}, geometry=circles, crs='EPSG:28350')
+
+    view, extent = _gdf_view(gdf, size=2, dpi=50, extent=(-1, -1, 7, 1))
+    assert len(view) == 3 and extent == (-1, -1, 7, 1)
+    assert view.total_bounds[2] <= 7
+    assert shapely.get_num_coordinates(view.geometry.values).max() < 200
+
+    plotgdf(gdf, 'unit', 'geology', savefig=False, size=2, dpi=50, rasterize=True, legend=True)
+    image = plt.gca().images[0].get_array()
+    assert image.shape == (7, 100)
+    assert set(np.unique(image.compressed())) == {0, 1, 2, 3, 4}
+    assert len(plt.gca().get_legend().get_texts()) == 5
+
+    plotgdf_da(gdf, _make_raster().squeeze('band'), None, 'overlay', cmap='color_white', savefig=False, size=2, extent=(-1, -1, 7, 1), rasterize=True)
+    plt.close('all')
+
+
+def test_histogram_counts_and_plothist():
+    """
+    Test streamed histogram counts match numpy and plothist_combo shares its bin edges.
+    """
+    import matplotlib.pyplot as plt
+
+    da = _make_raster().where(lambda x: x % 7 != 0)
+    expected, expected_edges = np.histogram(da.values[~np.isnan(da.values)], bins=20)
+
+    counts, edges = histogram_counts(da, bins=20)
+    assert np.array_equal(counts, expected) and np.allclose(edges, expected_edges)
+    lazy_counts, _ = histogram_counts(da.chunk(10), bins=20)
+    assert np.array_equal(lazy_counts, expected)
+
+    counts, edges = plothist(da.chunk(10), 'hist', savefig=False, bins=5)
+    assert counts.sum() == int(da.count())
+    counts, counts2, edges = plothist_combo(da, da * 2, 'combo', savefig=False, bins=5)
+    assert edges[0] == float(da.min()) and edges[-1] == float((da * 2).max())
+    assert counts.sum() == counts2.sum()
+    plt.close('all')
+
+
+def test_export_tiles(tmp_path):
+    """
+    Test the tile pyramid is written as xyz pngs and as mbtiles with empty tiles skipped.
+    """
+    import sqlite3
+    from PIL import Image
+
+    da = _make_raster(height=400, width=500, res=100.0).astype('float32')
+    da = da.where(da > 1000)
+
+    written = export_tiles(da, tmp_path / 'xyz', cmap='cetrainbow', robust=True)
+    pngs = sorted((tmp_path / 'xyz').glob('*/*/*.png'))
+    assert written == len(pngs) > 0
+    zooms = sorted({int(p.parts[-3]) for p in pngs})
+    assert zooms == list(range(zooms[0], zooms[-1] + 1)) and len(zooms) > 1
+    assert len(list((tmp_path / 'xyz' / str(zooms[0])).glob('*/*.png'))) <= 4
+
+    tile = np.asarray(Image.open(pngs[0]))
+    assert tile.shape == (256, 256, 4) and tile[..., 3].max() == 255
+
+    assert export_tiles(da.chunk(100), tmp_path / 'lazy', robust=True) == written
+    assert (tmp_path / 'lazy' / pngs[0].relative_to(tmp_path / 'xyz')).read_bytes() == pngs[0].read_bytes()
+
+    assert export_tiles(da, tmp_path / 'pyramid.mbtiles', method='max', min_zoom=zooms[0], max_zoom=zooms[-1]) == written
+    with sqlite3.connect(tmp_path / 'pyramid.mbtiles') as db:
+        assert db.execute('SELECT count(*) FROM tiles').fetchone()[0] == written
+        assert dict(db.execute('SELECT name, value FROM metadata'))['maxzoom'] == str(zooms[-1])
+
+
+def test_map_figure_template(tmp_path):
+    """
+    Test one template renders many same-grid maps and rejects other grids.
+    """
+    from PIL import Image
+
+    da = _make_raster(height=400, width=500)
+    template = MapFigure(da, size=2, dpi=50)
+    assert template.shape == (80, 100)
+
+    paths = [template.render(da * k, tmp_path / f'{k}.png', title=f'map {k}', robust=True) for k in (1, 2, 3)]
+    assert template.title.get_text() == 'map 3'
+    assert np.allclose(template.image.get_clim(), np.array(plot_limits(da, robust=True)) * 3)
+    sizes = {Image.open(path).size for path in paths}
+    assert len(sizes) == 1
+
+    with pytest.raises(ValueError):
+        template.update(_make_raster())
+
+
+def test_render_stack(tmp_path):
+    """
+    Test a stack renders to a gif and a png sequence with one shared colour scale.
+    """
+    from PIL import Image
+
+    base = _make_raster().squeeze('band', drop=True)
+    stack = xr.concat([base * k for k in (1, 2, 3)], dim=pd.Index(pd.date_range('2024-01-01', periods=3), name='time'))
+
+    gif = render_stack(stack.chunk({'time': 1}), tmp_path / 'stack.gif', size=2, dpi=50, title='grade')
+    with Image.open(gif) as image:
+        assert image.n_frames == 3
+
+    clipped = render_stack(stack, tmp_path / 'clipped', size=2, dpi=50, clip=90)
+    assert len(clipped) == 3
+
+    pngs = render_stack(stack, tmp_path / 'frames', size=2, dpi=50, vmin=0, vmax=1)
+    assert [os.path.basename(p) for p in pngs] == ['frame_0000.png', 'frame_0001.png', 'frame_0002.png']
+    assert len({Image.open(p).size for p in pngs}) == 1
+
+    # the range grows frame by frame, a sample that skips frames would miss the top of the scale
+    growing = xr.DataArray(np.broadcast_to(np.arange(12.0)[:, None, None], (12, 200, 200)), dims=('time', 'y', 'x'))
+    assert _color_limits(growing, robust=True, sample=10_000) == (0.0, 11.0)
+    assert _color_limits(growing.chunk({'time': 1}), robust=True, sample=10_000) == (0.0, 11.0)
+
+
+def test_import_does_not_load_pkg_resources():
+    """
+    Test importing the package skips pkg_resources and the version is read on first access.
+    """
+    import subprocess
+    import sys
+    from importlib.metadata import version
+
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import richardutils'], capture_output=True, text=True, check=True)
+    modules = [line.rsplit('|', 1)[-1].strip() for line in result.stderr.splitlines() if line.startswith('import time:')]
+    assert 'richardutils' in modules
+    assert not [m for m in modules if m.split('.')[0] == 'pkg_resources']
+
+    import richardutils
+    assert richardutils.__version__ == richardutils.VERSION == version('richardutils')